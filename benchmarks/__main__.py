@@ -0,0 +1,195 @@
+# Offline benchmarks for dynamicmacros.py
+#
+#   python -m benchmarks [--macros 500] [--option lazy_compile=True] [--json]
+
+import argparse
+import gc
+import json
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from .configs import write_config_tree, touch_macro
+from .klippy import Printer, load_dynamicmacros
+
+
+def measure(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.tmp = tempfile.TemporaryDirectory(prefix='dynamicmacros-bench-')
+        self.root = Path(self.tmp.name)
+        self.entry, self.leaves = write_config_tree(
+            self.root / 'config', macros=args.macros, depth=args.depth,
+            fanout=args.fanout, moves=args.moves, chunks=args.chunks,
+            python_every=args.python_every)
+        self.options = dict(option.split('=', 1) for option in args.option)
+        self.results = {}
+        self.revision = 0
+
+    def start(self):
+        # A fresh module per printer, so no cache survives between runs
+        dm = load_dynamicmacros()
+        printer = Printer(self.root / 'config', self.root / 'logs')
+        (self.root / 'logs').mkdir(exist_ok=True)
+        options = {'configs': self.entry, **self.options}
+        main = printer.load(dm, 'dynamicmacros', options)
+        printer.ready()
+        printer.reactor.run_due()
+        return dm, printer, main
+
+    def record(self, name, samples, unit='ms'):
+        scale = 1000. if unit == 'ms' else 1.
+        self.results[name] = {
+            'unit': unit,
+            'median': statistics.median(samples) * scale,
+            'min': min(samples) * scale,
+            'max': max(samples) * scale,
+            'runs': len(samples),
+        }
+
+    def touch(self):
+        self.revision += 1
+        touch_macro(self.leaves[0], 0, self.revision)
+
+    def run(self):
+        args = self.args
+        self.record('startup (load + ready)', measure(self.start, args.startup))
+
+        dm, printer, main = self.start()
+        gcode = printer.lookup_object('gcode')
+        configfile = printer.lookup_object('configfile')
+        name = 'BENCH_0001'
+
+        self.record('reload, nothing changed',
+                    measure(main._update_macros, args.repeat))
+
+        def reload_one_changed():
+            self.touch()
+            main._update_macros()
+        self.record('reload, one macro changed',
+                    measure(reload_one_changed, args.repeat))
+
+        def invoke():
+            gcode.run_script_from_command(name)
+            gcode.executed.clear()
+        self.record(f'invoke {name} (render + dispatch)',
+                    measure(invoke, args.repeat))
+
+        def invoke_python():
+            gcode.run_script_from_command('BENCH_0000')
+            gcode.executed.clear()
+        self.record('invoke BENCH_0000 (with python())',
+                    measure(invoke_python, args.repeat))
+
+        def dynamic_macro():
+            gcode.run_script_from_command(f'DYNAMIC_MACRO MACRO={name}')
+            gcode.executed.clear()
+        self.record(f'DYNAMIC_MACRO MACRO={name}',
+                    measure(dynamic_macro, args.repeat))
+
+        def dynamic_render():
+            gcode.run_script_from_command(f'DYNAMIC_RENDER MACRO={name}')
+            gcode.responses.clear()
+        self.record(f'DYNAMIC_RENDER MACRO={name}',
+                    measure(dynamic_render, args.repeat))
+
+        eventtime = printer.reactor.monotonic()
+        self.record('configfile status poll',
+                    measure(lambda: configfile.get_status(eventtime),
+                            args.repeat))
+
+        self.memory_growth(main, gcode)
+        return self.results
+
+    def memory_growth(self, main, gcode):
+        reloads = self.args.memory_reloads
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for _ in range(reloads):
+            self.touch()
+            main._update_macros()
+            gcode.run_script_from_command('BENCH_0000')
+            gcode.executed.clear()
+            gcode.responses.clear()
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        growth = sum(stat.size_diff for stat in after.compare_to(
+            before, 'filename'))
+        self.results[f'memory growth over {reloads} reloads'] = {
+            'unit': 'KiB', 'total': growth / 1024.,
+            'per_reload': growth / 1024. / reloads, 'runs': reloads,
+        }
+
+    def close(self):
+        self.tmp.cleanup()
+
+
+def format_results(results):
+    lines = []
+    width = max(len(name) for name in results)
+    for name, result in results.items():
+        if 'median' in result:
+            lines.append(f'{name:<{width}}  median {result["median"]:9.3f} '
+                         f'{result["unit"]}  min {result["min"]:9.3f}  '
+                         f'max {result["max"]:9.3f}  ({result["runs"]} runs)')
+        else:
+            lines.append(f'{name:<{width}}  total {result["total"]:10.1f} '
+                         f'{result["unit"]}  per reload '
+                         f'{result["per_reload"]:.2f} {result["unit"]}')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Benchmark dynamicmacros.py against a fake Klipper.')
+    parser.add_argument('--macros', type=int, default=300)
+    parser.add_argument('--depth', type=int, default=3,
+                        help='levels of [include] globs (default 3)')
+    parser.add_argument('--fanout', type=int, default=3,
+                        help='included files per level (default 3)')
+    parser.add_argument('--moves', type=int, default=20,
+                        help='moves generated per macro (default 20)')
+    parser.add_argument('--chunks', type=int, default=3,
+                        help='delimiter-separated chunks per macro')
+    parser.add_argument('--python-every', type=int, default=5,
+                        help='every Nth macro has a python() block')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--startup', type=int, default=3,
+                        help='startup runs (default 3)')
+    parser.add_argument('--memory-reloads', type=int, default=20)
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='extra [dynamicmacros] option, may be repeated')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    bench = Bench(args)
+    try:
+        results = bench.run()
+    finally:
+        bench.close()
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print(format_results(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# Synthetic macro libraries for the benchmarks
+
+import os
+from pathlib import Path
+
+PRINTER_CFG = """[printer]
+kinematics: none
+"""
+
+MACRO_TEMPLATE = """[gcode_macro BENCH_{index:04d}]
+description: Synthetic macro {index}
+variable_count: {moves}
+variable_offset: {index}
+gcode:
+    {{% set speed = params.SPEED|default(3000)|int %}}
+    {{% for i in range(count) %}}
+    G1 X{{i + offset}} Y{{i * 2}} F{{speed}}
+    {{% endfor %}}
+{extra}
+"""
+
+CHUNK_TEMPLATE = """    {delimiter}
+    {{% set total = count + offset %}}
+    M117 chunk {chunk} of {{total}}
+"""
+
+PYTHON_TEMPLATE = """    {% set result = python("output(sum(range(args[0])))", count) %}
+    M118 python {result}
+"""
+
+
+def macro_text(index, moves=10, chunks=2, python=False, delimiter='---'):
+    extra = ''.join(CHUNK_TEMPLATE.format(delimiter=delimiter, chunk=chunk)
+                    for chunk in range(1, chunks))
+    if python:
+        extra += PYTHON_TEMPLATE
+    return MACRO_TEMPLATE.format(index=index, moves=moves, extra=extra)
+
+
+def write_config_tree(root, macros=200, depth=3, fanout=3, moves=10,
+                      chunks=2, python_every=5, delimiter='---'):
+    # Writes printer.cfg plus a dynamic macro library whose entry point
+    # (macros/main.cfg) reaches the leaf files through `depth` levels of
+    # glob includes. Returns the entry point relative to the config dir and
+    # the list of leaf files holding macros.
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    (root / 'printer.cfg').write_text(PRINTER_CFG)
+    library = root / 'macros'
+    library.mkdir(exist_ok=True)
+    (library / 'main.cfg').write_text('[include level0/*.cfg]\n')
+
+    leaves = []
+    def build(directory, level):
+        directory.mkdir(parents=True, exist_ok=True)
+        for i in range(fanout):
+            stem = f'group{i}'
+            path = directory / f'{stem}.cfg'
+            if level + 1 < depth:
+                path.write_text(f'[include {stem}/*.cfg]\n')
+                build(directory / stem, level + 1)
+            else:
+                leaves.append(path)
+    build(library / 'level0', 0)
+
+    texts = [[] for _ in leaves]
+    for index in range(macros):
+        python = python_every and index % python_every == 0
+        texts[index % len(leaves)].append(macro_text(
+            index, moves=moves, chunks=chunks, python=python,
+            delimiter=delimiter))
+    for path, parts in zip(leaves, texts):
+        path.write_text('\n'.join(parts))
+    return os.path.join('macros', 'main.cfg'), leaves
+
+
+def touch_macro(path, index, revision):
+    # Change the description of one macro so its section really differs
+    text = Path(path).read_text()
+    marker = f'description: Synthetic macro {index}'
+    start = text.find(marker + '\n')
+    if start < 0:
+        start = text.find(marker + ' ')
+    if start < 0:
+        raise ValueError(f'BENCH_{index:04d} is not in {path}')
+    end = text.index('\n', start)
+    text = text[:start] + f'{marker} (rev {revision})' + text[end:]
+    Path(path).write_text(text)
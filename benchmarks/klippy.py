@@ -0,0 +1,479 @@
+# Minimal stand-ins for the parts of Klipper that dynamicmacros.py uses, so
+# the module can be exercised and measured without a printer attached
+
+import importlib.util
+import itertools
+import sys
+import time
+import types
+from pathlib import Path
+
+import jinja2
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+
+
+class ConfigError(Exception):
+    pass
+
+
+class CommandError(Exception):
+    pass
+
+
+class GetStatusWrapper:
+    def __init__(self, printer, eventtime=None):
+        self.printer = printer
+        self.eventtime = eventtime
+        self.cache = {}
+
+    def __getitem__(self, val):
+        sval = str(val).strip()
+        if sval in self.cache:
+            return self.cache[sval]
+        po = self.printer.lookup_object(sval, None)
+        if po is None or not hasattr(po, 'get_status'):
+            raise KeyError(val)
+        if self.eventtime is None:
+            self.eventtime = self.printer.get_reactor().monotonic()
+        self.cache[sval] = res = dict(po.get_status(self.eventtime))
+        return res
+
+    def __contains__(self, val):
+        try:
+            self.__getitem__(val)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for name, obj in self.printer.lookup_objects():
+            if self.__contains__(name):
+                yield name
+
+
+class TemplateWrapper:
+    def __init__(self, printer, env, name, script):
+        self.printer = printer
+        self.name = name
+        self.gcode = self.printer.lookup_object('gcode')
+        gcode_macro = self.printer.lookup_object('gcode_macro')
+        self.create_template_context = gcode_macro.create_template_context
+        try:
+            self.template = env.from_string(script)
+        except Exception as e:
+            raise printer.config_error(
+                "Error loading template '%s': %s" % (name, e))
+
+    def render(self, context=None):
+        if context is None:
+            context = self.create_template_context()
+        try:
+            return str(self.template.render(context))
+        except Exception as e:
+            raise self.gcode.error(
+                "Error evaluating '%s': %s" % (self.name, e))
+
+    def run_gcode_from_command(self, context=None):
+        self.gcode.run_script_from_command(self.render(context))
+
+
+class PrinterGCodeMacro:
+    def __init__(self, printer):
+        self.printer = printer
+        self.env = jinja2.Environment('{%', '%}', '{', '}')
+
+    def create_template_context(self, eventtime=None):
+        return {
+            'printer': GetStatusWrapper(self.printer, eventtime),
+            'action_emergency_stop': self._action_emergency_stop,
+            'action_respond_info': self._action_respond_info,
+            'action_raise_error': self._action_raise_error,
+            'action_call_remote_method': self._action_call_remote_method,
+        }
+
+    def _action_emergency_stop(self, msg='action_emergency_stop'):
+        return ''
+
+    def _action_respond_info(self, msg):
+        self.printer.lookup_object('gcode').respond_info(msg)
+        return ''
+
+    def _action_raise_error(self, msg):
+        raise self.printer.command_error(msg)
+
+    def _action_call_remote_method(self, method, **kwargs):
+        return ''
+
+
+class GCodeCommand:
+    def __init__(self, gcode, command, commandline, params):
+        self._command = command
+        self._commandline = commandline
+        self._params = params
+        self.error = gcode.error
+        self.respond_info = gcode.respond_info
+
+    def get_command_parameters(self):
+        return self._params
+
+    def get_raw_command_parameters(self):
+        command = self._command
+        rawparams = self._commandline
+        urawparams = rawparams.upper()
+        if not urawparams.startswith(command):
+            rawparams = rawparams[urawparams.find(command):]
+        return rawparams[len(command):].strip()
+
+    def get(self, name, default=None, parser=str, minval=None, maxval=None):
+        value = self._params.get(name)
+        if value is None:
+            return default
+        value = parser(value)
+        if minval is not None and value < minval:
+            raise self.error('%s below minimum' % (name,))
+        return value
+
+    def get_int(self, name, default=None, minval=None, maxval=None):
+        return self.get(name, default, int, minval, maxval)
+
+    def get_float(self, name, default=None, minval=None, maxval=None):
+        return self.get(name, default, float, minval, maxval)
+
+
+class GCodeDispatch:
+    error = CommandError
+
+    def __init__(self, printer):
+        self.printer = printer
+        self.base_gcode_handlers = {}
+        self.ready_gcode_handlers = {}
+        self.gcode_handlers = self.ready_gcode_handlers
+        self.mux_commands = {}
+        self.gcode_help = {}
+        self.status_commands = {}
+        self.responses = []
+        self.executed = []
+        self.status_builds = 0
+
+    def register_command(self, cmd, func, when_not_ready=False, desc=None):
+        if func is None:
+            old_cmd = self.ready_gcode_handlers.get(cmd)
+            self.ready_gcode_handlers.pop(cmd, None)
+            self.base_gcode_handlers.pop(cmd, None)
+            self._build_status_commands()
+            return old_cmd
+        if cmd in self.ready_gcode_handlers:
+            raise self.printer.config_error(
+                'gcode command %s already registered' % (cmd,))
+        self.ready_gcode_handlers[cmd] = func
+        if when_not_ready:
+            self.base_gcode_handlers[cmd] = func
+        if desc is not None:
+            self.gcode_help[cmd] = desc
+        self._build_status_commands()
+
+    def register_mux_command(self, cmd, key, value, func, desc=None):
+        prev = self.mux_commands.get(cmd)
+        if prev is None:
+            def handler(gcmd):
+                return self._cmd_mux(cmd, gcmd)
+            self.register_command(cmd, handler, desc=desc)
+            self.mux_commands[cmd] = prev = (key, {})
+        prev_key, prev_values = prev
+        if prev_key != key:
+            raise self.printer.config_error('mux key mismatch')
+        if value in prev_values:
+            raise self.printer.config_error(
+                "mux command %s %s %s already registered" % (cmd, key, value))
+        prev_values[value] = func
+
+    def _cmd_mux(self, command, gcmd):
+        key, values = self.mux_commands[command]
+        key_param = gcmd.get(key, None)
+        if key_param not in values:
+            raise gcmd.error('The value %s is not valid for %s' % (
+                key_param, key))
+        values[key_param](gcmd)
+
+    def _build_status_commands(self):
+        self.status_builds += 1
+        commands = {cmd: {} for cmd in self.gcode_handlers}
+        for cmd in self.gcode_help:
+            if cmd in commands:
+                commands[cmd]['help'] = self.gcode_help[cmd]
+        self.status_commands = commands
+
+    def respond_info(self, msg, log=True):
+        self.responses.append(msg)
+
+    def respond_raw(self, msg):
+        self.responses.append(msg)
+
+    def _parse(self, line):
+        line = line.strip()
+        if not line:
+            return None, None, {}
+        parts = line.split(None, 1)
+        cmd = parts[0].upper()
+        params = {}
+        if len(parts) > 1:
+            for word in parts[1].split():
+                if '=' in word:
+                    k, v = word.split('=', 1)
+                    params[k.upper()] = v
+        return cmd, line, params
+
+    def run_script_from_command(self, script):
+        for line in script.split('\n'):
+            cmd, commandline, params = self._parse(line)
+            if cmd is None:
+                continue
+            handler = self.gcode_handlers.get(cmd)
+            if handler is None:
+                # Plain moves and unknown commands are recorded, not run
+                self.executed.append(commandline)
+                continue
+            handler(GCodeCommand(self, cmd, commandline, params))
+
+    run_script = run_script_from_command
+
+
+class ConfigFile:
+    def __init__(self):
+        self.status_raw_config = {}
+
+    def get_status(self, eventtime):
+        return {'config': self.status_raw_config, 'settings': {},
+                'warnings': [], 'save_config_pending': False,
+                'save_config_pending_items': {}}
+
+
+class Timer:
+    def __init__(self, callback, waketime):
+        self.callback = callback
+        self.waketime = waketime
+
+
+class Completion:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.result = None
+        self.done = False
+
+    def test(self):
+        return self.done
+
+    def complete(self, result):
+        self.result = result
+        self.done = True
+
+    def wait(self, waketime=None, waketime_result=None):
+        if waketime is None:
+            waketime = self.reactor.NEVER
+        while not self.done:
+            if self.reactor.monotonic() >= waketime:
+                return waketime_result
+            self.reactor.pause(self.reactor.monotonic() + 0.001)
+        return self.result
+
+
+class Reactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+
+    def __init__(self):
+        self.timers = []
+        self.fds = {}
+        self.async_queue = []
+        self._clock_offset = 0.
+
+    def monotonic(self):
+        return time.monotonic() + self._clock_offset
+
+    def register_timer(self, callback, waketime=NEVER):
+        timer = Timer(callback, waketime)
+        self.timers.append(timer)
+        return timer
+
+    def update_timer(self, timer, waketime):
+        timer.waketime = waketime
+
+    def unregister_timer(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    def register_fd(self, fd, read_callback, write_callback=None):
+        self.fds[fd] = read_callback
+        return fd
+
+    def unregister_fd(self, handle):
+        self.fds.pop(handle, None)
+
+    def register_callback(self, callback, waketime=NOW):
+        def wrapper(eventtime):
+            callback(eventtime)
+            return self.NEVER
+        self.register_timer(wrapper, waketime)
+
+    def register_async_callback(self, callback, waketime=NOW):
+        self.async_queue.append(callback)
+
+    def completion(self):
+        return Completion(self)
+
+    def async_complete(self, completion, result):
+        self.async_queue.append(lambda eventtime: completion.complete(result))
+
+    def pause(self, waketime):
+        self._run_async()
+        delay = waketime - self.monotonic()
+        if delay > 0:
+            time.sleep(min(delay, 0.001))
+        return self.monotonic()
+
+    def _run_async(self):
+        while self.async_queue:
+            self.async_queue.pop(0)(self.monotonic())
+
+    def advance(self, seconds):
+        # Move the clock forward and fire every timer that became due
+        self._clock_offset += seconds
+        self.run_due()
+
+    def run_due(self):
+        self._run_async()
+        now = self.monotonic()
+        for timer in list(self.timers):
+            while timer in self.timers and timer.waketime <= now:
+                timer.waketime = timer.callback(now)
+
+
+class Printer:
+    config_error = ConfigError
+    command_error = CommandError
+
+    def __init__(self, config_dir, log_dir=None):
+        config_dir = Path(config_dir)
+        log_dir = Path(log_dir or config_dir)
+        self.start_args = {
+            'config_file': str(config_dir / 'printer.cfg'),
+            'log_file': str(log_dir / 'klippy.log'),
+        }
+        self.reactor = Reactor()
+        self.event_handlers = {}
+        self.objects = {}
+        self.objects['gcode'] = GCodeDispatch(self)
+        self.objects['gcode_macro'] = PrinterGCodeMacro(self)
+        self.objects['configfile'] = ConfigFile()
+
+    def get_reactor(self):
+        return self.reactor
+
+    def lookup_object(self, name, default=KeyError):
+        if name in self.objects:
+            return self.objects[name]
+        if default is KeyError:
+            raise self.config_error("Unknown config object '%s'" % (name,))
+        return default
+
+    def lookup_objects(self, module=None):
+        if module is None:
+            return list(self.objects.items())
+        prefix = module + ' '
+        return [(name, obj) for name, obj in self.objects.items()
+                if name.startswith(prefix) or name == module]
+
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+
+    def load(self, module, section, options):
+        config = ConfigWrapper(self, section, options)
+        if ' ' in section:
+            obj = module.load_config_prefix(config)
+        else:
+            obj = module.load_config(config)
+        self.objects[section] = obj
+        return obj
+
+    def ready(self):
+        self.send_event('klippy:connect')
+        gcode = self.objects['gcode']
+        gcode.gcode_handlers = gcode.ready_gcode_handlers
+        self.send_event('klippy:ready')
+
+
+class ConfigWrapper:
+    error = ConfigError
+    sentinel = object()
+
+    def __init__(self, printer, section, options):
+        self.printer = printer
+        self.section = section
+        self.options = {k.lower(): str(v) for k, v in options.items()}
+
+    def get_printer(self):
+        return self.printer
+
+    def get_name(self):
+        return self.section
+
+    def _get(self, option, default, parser):
+        if option not in self.options:
+            if default is self.sentinel:
+                raise self.error("Option '%s' in section '%s' must be "
+                                 "specified" % (option, self.section))
+            return default
+        return parser(self.options[option])
+
+    def get(self, option, default=sentinel):
+        return self._get(option, default, str)
+
+    def getint(self, option, default=sentinel, minval=None, maxval=None):
+        return self._get(option, default, int)
+
+    def getfloat(self, option, default=sentinel, minval=None, maxval=None,
+                 above=None, below=None):
+        return self._get(option, default, float)
+
+    def getboolean(self, option, default=sentinel):
+        return self._get(option, default,
+                         lambda v: v.strip().lower() in ('1', 'true', 'yes'))
+
+    def getchoice(self, option, choices, default=sentinel):
+        if isinstance(choices, list):
+            choices = {c: c for c in choices}
+        return self._get(option, default, lambda v: choices[v])
+
+    def getlist(self, option, default=sentinel, sep=','):
+        return self._get(option, default, lambda v: [
+            p.strip() for p in v.split(sep) if p.strip()])
+
+
+_module_counter = itertools.count()
+
+
+def load_dynamicmacros():
+    # dynamicmacros.py is a Klipper "extras" module that imports its
+    # TemplateWrapper relative to klippy/extras, so load it inside a
+    # throwaway package that provides the harness gcode_macro module.
+    package = f'_dm_extras{next(_module_counter)}'
+    pkg = types.ModuleType(package)
+    pkg.__path__ = []
+    sys.modules[package] = pkg
+    gcode_macro = types.ModuleType(f'{package}.gcode_macro')
+    gcode_macro.TemplateWrapper = TemplateWrapper
+    sys.modules[f'{package}.gcode_macro'] = gcode_macro
+    spec = importlib.util.spec_from_file_location(
+        f'{package}.dynamicmacros', REPO_PATH / 'dynamicmacros.py')
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    module.DYNAMICMACROS_PATH = REPO_PATH
+    return module
@@ -1,16 +1,34 @@
+import array
 import ast
+import atexit
+import contextlib
+import cProfile
+import ctypes
+import ctypes.util
 import traceback
 import configparser
 import glob
+import hashlib
+import heapq
+import itertools
 import json
 import logging
 import textwrap
+import threading
+import types
+import weakref
 import os
+import pstats
+import queue
 import re
-import subprocess
+import shutil
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import StringIO
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from secrets import token_hex
 
 DYNAMICMACROS_PATH = Path.home() / 'DynamicMacros'
 
@@ -26,66 +44,498 @@ config_path = Path(os.path.expanduser('~')) / 'printer_data' / 'config'
 
 logger = None
 
+LOG_LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO,
+              'warning': logging.WARNING, 'error': logging.ERROR}
+
+class RateLimitFilter(logging.Filter):
+    # Lets at most `limit` records from each logging call through every
+    # INTERVAL seconds, and notes how many were dropped on the next one
+    INTERVAL = 10.
+
+    def __init__(self, limit=0):
+        super().__init__()
+        self.limit = limit # 0 for unlimited
+        self.events = {} # (pathname, lineno) -> (window start, count, dropped)
+
+    def filter(self, record):
+        if not self.limit:
+            return True
+        key = (record.pathname, record.lineno)
+        start, count, dropped = self.events.get(key, (record.created, 0, 0))
+        if record.created - start >= self.INTERVAL:
+            if dropped:
+                record.msg = f'({dropped} similar messages suppressed) {record.msg}'
+            start, count, dropped = record.created, 0, 0
+        if count >= self.limit:
+            self.events[key] = (start, count, dropped + 1)
+            return False
+        self.events[key] = (start, count + 1, dropped)
+        return True
+
+# Parsed config files shared by every instance and cluster:
+# path -> (stat key, content hash, entries)
+config_file_cache = {}
+
+# Instances owning each registered macro name, per printer
+macro_owners = weakref.WeakKeyDictionary()
+
+# Bumped whenever the parsed file cache changes shape
+SNAPSHOT_VERSION = 2
+
+# Jinja environments shared by every macro, keyed by bytecode cache directory
+jinja_envs = {}
+
+# Compiled macro definitions per printer, keyed by section source,
+# delimiter and Jinja environment
+macro_definitions = weakref.WeakKeyDictionary()
+
+# Persistent variable stores per printer, keyed by file path
+variable_stores = weakref.WeakKeyDictionary()
+
+# The interface workaround writer of each printer
+workaround_writers = weakref.WeakKeyDictionary()
+
 def clean_gcode(gcode):
     gcode = '\n' + gcode.strip() + '\n'
     gcode = re.sub(r'\n+', '\n', gcode)
     gcode = textwrap.indent(gcode, ' '*4)
     return gcode.strip()
 
+def write_atomic(path, data):
+    # Readers see either the old or the new file, never a partial one. A
+    # symlink is written through to its target, which keeps its mode.
+    path = os.path.realpath(path)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    if os.path.exists(path):
+        shutil.copymode(path, tmp_path)
+    os.replace(tmp_path, path)
+
+def stream_template(template, context):
+    # Like TemplateWrapper.render, but yields the output as Jinja produces
+    # it, and the context (which already holds the Jinja globals) is used
+    # as is instead of being copied twice by Jinja
+    jinja_template = template.template
+    try:
+        try:
+            context = jinja_template.new_context(context, shared=True)
+            yield from jinja_template.root_render_func(context)
+        except Exception:
+            jinja_template.environment.handle_exception()
+    except Exception as e:
+        msg = "Error evaluating '%s': %s" % (
+            template.name, traceback.format_exception_only(type(e), e)[-1])
+        logging.exception(msg)
+        raise template.gcode.error(msg)
+
+def render_template(template, context):
+    return template.template.environment.concat(
+        stream_template(template, context))
+
+def get_jinja_env(bytecode_dir=None, cache_size=512):
+    env = jinja_envs.get(bytecode_dir)
+    if env is None:
+        env = jinja_envs[bytecode_dir] = MacroEnvironment(bytecode_dir)
+    env.template_cache.maxsize = cache_size
+    return env
+
+class LRUCache(OrderedDict):
+    def __init__(self, maxsize=128):
+        super().__init__()
+        self.maxsize = maxsize # 0 for unbounded
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        try:
+            value = self[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if self.maxsize and len(self) > self.maxsize:
+            self.popitem(last=False)
+
+# Compiled python() blocks keyed by source hash, python_file() keyed by
+# path, mtime and size so edits are picked up
+python_code_cache = LRUCache(256)
+python_file_cache = LRUCache(64)
+
+def compile_python(source, filename='<python>'):
+    key = (filename, hashlib.sha1(source.encode()).hexdigest())
+    code = python_code_cache.lookup(key)
+    if code is None:
+        code = compile(source, filename, 'exec')
+        python_code_cache[key] = code
+    return code
+
+def load_python_file(path):
+    stat = os.stat(path)
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    code = python_file_cache.lookup(key)
+    if code is None:
+        with open(path, 'r') as file:
+            text = file.read()
+        code = compile(text, str(path), 'exec')
+        python_file_cache[key] = code
+    return code
+
+class MacroEnvironment(jinja2.Environment):
+    # Compiled templates are shared between macros and reloads, keyed by
+    # a hash of their source, and optionally backed by on-disk bytecode
+    def __init__(self, bytecode_dir=None):
+        bytecode_cache = None
+        if bytecode_dir is not None:
+            os.makedirs(bytecode_dir, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_dir)
+        super().__init__('{%', '%}', '{', '}', bytecode_cache=bytecode_cache)
+        self.template_cache = LRUCache()
+
+    def from_string(self, source, globals=None, template_class=None):
+        if globals is not None or template_class is not None:
+            return super().from_string(source, globals, template_class)
+        key = hashlib.sha1(source.encode()).hexdigest()
+        template = self.template_cache.lookup(key)
+        if template is None:
+            template = self._compile_template(source, key)
+            self.template_cache[key] = template
+        return template
+
+    def _compile_template(self, source, key):
+        if self.bytecode_cache is None:
+            return super().from_string(source)
+        bucket = self.bytecode_cache.get_bucket(self, key, None, source)
+        if bucket.code is None:
+            bucket.code = self.compile(source)
+            self.bytecode_cache.set_bucket(bucket)
+        return self.template_class.from_code(
+            self, bucket.code, self.make_globals(None))
+
+class ConfigSection:
+    # A parsed [section], remembering the file and lines it came from
+    def __init__(self, name, path, lineno):
+        self.name = name
+        self.path = path
+        self.lineno = lineno
+        self.options = {}
+        self.linenos = {} # option -> file line of every value line
+
+    def merged(self, other):
+        section = ConfigSection(self.name, self.path, self.lineno)
+        section.options = {**self.options, **other.options}
+        section.linenos = {**self.linenos, **other.linenos}
+        return section
+
+    def items(self):
+        return list(self.options.items())
+
+    def has_option(self, option):
+        return option in self.options
+
+    def get(self, option, fallback=configparser._UNSET):
+        if option not in self.options:
+            if fallback is configparser._UNSET:
+                raise configparser.NoOptionError(option, self.name)
+            return fallback
+        return self.options[option]
+
+    def getfloat(self, option, fallback=configparser._UNSET):
+        value = self.get(option, fallback)
+        return value if value is fallback else float(value)
+
+    def getboolean(self, option, fallback=configparser._UNSET):
+        value = self.get(option, fallback)
+        if value is fallback:
+            return value
+        if value.lower() not in configparser.RawConfigParser.BOOLEAN_STATES:
+            raise ValueError(f'Not a boolean: {value}')
+        return configparser.RawConfigParser.BOOLEAN_STATES[value.lower()]
+
+    def gcode_lines(self):
+        # File line of every line of the gcode option after clean_gcode,
+        # which drops the blank ones
+        value = self.options.get('gcode', '')
+        linenos = self.linenos.get('gcode', [])
+        return [lineno for line, lineno in zip(value.split('\n'), linenos)
+                if line]
+
+class ConfigInclude:
+    def __init__(self, spec, path, lineno):
+        self.spec = spec
+        self.path = path
+        self.lineno = lineno
+
+def parse_config(path, lines):
+    # Tokenize one config file the way RawConfigParser(strict=False,
+    # inline_comment_prefixes=(';', '#')) does, but keep [include] sections
+    # in place and record the line number of every value line
+    entries = []
+    section = None
+    optname = None
+    indent_level = 0
+    errors = None
+    for lineno, line in enumerate(lines, 1):
+        # Scan the prefixes occurrence by occurrence and stop at the first
+        # round that finds a comment, as RawConfigParser does
+        comment_start = None
+        indices = {';': -1, '#': -1}
+        while comment_start is None and indices:
+            found = {}
+            for prefix, index in indices.items():
+                index = line.find(prefix, index + 1)
+                if index == -1:
+                    continue
+                found[prefix] = index
+                if index == 0 or line[index - 1].isspace():
+                    if comment_start is None or index < comment_start:
+                        comment_start = index
+            indices = found
+        if line.strip().startswith(('#', ';')):
+            comment_start = 0
+        value = line[:comment_start].strip()
+        if not value:
+            # Empty lines are kept in values, comment lines are not
+            if comment_start is None and section is not None and optname:
+                section.options[optname].append('')
+                section.linenos[optname].append(lineno)
+            continue
+        cur_indent_level = len(line) - len(line.lstrip())
+        if section is not None and optname and cur_indent_level > indent_level:
+            section.options[optname].append(value)
+            section.linenos[optname].append(lineno)
+            continue
+        indent_level = cur_indent_level
+        mo = configparser.RawConfigParser.SECTCRE.match(value)
+        if mo:
+            header = mo.group('header')
+            optname = None
+            if header.startswith('include '):
+                entries.append(ConfigInclude(header[8:].strip(), path, lineno))
+                section = ConfigSection(header, path, lineno) # Ignored
+            else:
+                section = ConfigSection(header, path, lineno)
+                entries.append(section)
+            continue
+        if section is None:
+            raise configparser.MissingSectionHeaderError(str(path), lineno, line)
+        mo = configparser.RawConfigParser.OPTCRE.match(value)
+        if not mo or not mo.group('option'):
+            if errors is None:
+                errors = configparser.ParsingError(str(path))
+            errors.append(lineno, repr(line))
+            continue
+        optname = mo.group('option').rstrip().lower()
+        section.options[optname] = [mo.group('value').strip()]
+        section.linenos[optname] = [lineno]
+    if errors is not None:
+        raise errors
+    for section in entries:
+        if isinstance(section, ConfigSection):
+            for option, value in section.options.items():
+                section.options[option] = '\n'.join(value).rstrip()
+    return entries
+
+def merge_sections(sections):
+    # Sections with the same name are merged, later options winning, and
+    # the [DEFAULT] options apply to every other section, as in
+    # RawConfigParser
+    merged = {}
+    for section in sections:
+        if section.name in merged:
+            section = merged[section.name].merged(section)
+        merged[section.name] = section
+    defaults = merged.pop(configparser.DEFAULTSECT, None)
+    if defaults is not None:
+        for name, section in merged.items():
+            merged[name] = ConfigSection(name, section.path, section.lineno)
+            merged[name].options = {**defaults.options, **section.options}
+            merged[name].linenos = {**defaults.linenos, **section.linenos}
+    return merged
+
 class MacroConfigParser:
-    def __init__(self, printer, delimiter):
+    def __init__(self, printer, delimiter, macro_options={}):
         global config_path
         self.printer = printer
         self.delimiter = delimiter
+        self.macro_options = macro_options
 
         self.config_file = printer.start_args['config_file']
         self.config_path = Path(os.path.dirname(self.config_file))
         config_path = self.config_path
 
+        self.file_cache = config_file_cache
+        self.macro_cache = {} # filename -> (include tree fingerprint, macros)
+        self.watch_dirs = set() # Directories holding the include graph
+        self.stats = {'file_hits': 0, 'file_misses': 0, 'tree_hits': 0,
+                      'tree_misses': 0, 'macros_reused': 0, 'macros_built': 0}
+
     def read_config_file(self, filename):
-        buffer = self._read_file(filename)
-        sbuffer = StringIO('\n'.join(buffer))
         config = configparser.RawConfigParser(
             strict=False, inline_comment_prefixes=(';', '#'))
-        config.read_file(sbuffer, filename)
+        for section in self.read_sections(filename).values():
+            config.add_section(section.name)
+            for option, value in section.items():
+                config.set(section.name, option, value)
         return config
 
-    def _read_file(self, filename, visited=[]):
+    def read_macros(self, filename):
+        # Only rebuild macros when a file in the include tree has changed,
+        # and keep the previous DynamicMacro for every unchanged section
+        files = []
+        sections = self.read_sections(filename, files)
+        fingerprint = tuple(files)
+        cached = self.macro_cache.get(filename)
+        if cached is not None and cached[0] == fingerprint:
+            self.stats['tree_hits'] += 1
+            return cached[1]
+        self.stats['tree_misses'] += 1
+        previous = cached[1] if cached is not None else {}
+        macros = self.extract_macros(sections, previous)
+        self.macro_cache[filename] = (fingerprint, macros)
+        return macros
+
+    def read_sections(self, filename, files=None):
+        return merge_sections(self.iter_sections(filename, files))
+
+    def iter_sections(self, filename, files=None, visited=None):
+        # Walk the include graph once, yielding the cached sections of
+        # every file in include order
+        if visited is None:
+            visited = set()
         path = self.config_path / filename
         if not os.path.exists(path):
             raise MissingConfigError(f'Missing Configuration at {path}')
         if path in visited:
             raise RecursiveConfigError(f'Recursively included file at {path}')
-        visited.append(path) # Keep a list of files previously included
-        buffer = [] # List of lines in the file
-        with open(path, 'r') as file:
-            for line in file.readlines():
-                mo = configparser.RawConfigParser.SECTCRE.match(line)
-                header = mo and mo.group('header')
+        visited.add(path) # Keep track of the files currently being included
+        digest, entries = self._read_entries(path)
+        if files is not None:
+            files.append((path, digest))
+        self.watch_dirs.add(str(path.parent))
+        try:
+            for entry in entries:
+                if isinstance(entry, ConfigSection):
+                    yield entry
+                    continue
                 # Handle [include xxx.cfg] sections
-                if header and header.startswith('include '):
-                    include_spec = header[8:].strip()
-                    include_path = str(path.parent / include_spec)
-                    include_filenames = glob.glob(include_path, recursive=True)
-                    for filename in include_filenames:
-                        buffer.extend(self._read_file(filename, visited))
-                else:
-                    buffer.append(line)
-        visited.remove(path)
-        return buffer
-
-    def extract_macros(self, config):
+                include_path = str(path.parent / entry.spec)
+                self.watch_dirs.add(self._glob_base(include_path))
+                for filename in sorted(glob.glob(include_path, recursive=True)):
+                    yield from self.iter_sections(filename, files, visited)
+        finally:
+            visited.discard(path)
+
+    def _read_entries(self, path):
+        stat = os.stat(path)
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        cached = self.file_cache.get(path)
+        if cached is not None and cached[0] == stat_key:
+            self.stats['file_hits'] += 1
+            return cached[1], cached[2]
+        self.stats['file_misses'] += 1
+        with open(path, 'r') as file:
+            text = file.read()
+        digest = hashlib.sha1(text.encode()).hexdigest()
+        if cached is not None and cached[1] == digest:
+            entries = cached[2] # Touched but unchanged
+        else:
+            entries = parse_config(path, text.splitlines())
+        self.file_cache[path] = (stat_key, digest, entries)
+        return digest, entries
+
+    def snapshot_key(self):
+        # Snapshots are only valid for the code that wrote them
+        stat = os.stat(__file__)
+        return [SNAPSHOT_VERSION, stat.st_mtime_ns, stat.st_size]
+
+    def load_snapshot(self, path):
+        # Seed the file cache with the files parsed by a previous run. An
+        # entry is only used while its file keeps the same mtime and size.
+        try:
+            with open(path, 'r') as file:
+                snapshot = json.load(file)
+            if snapshot['key'] != self.snapshot_key():
+                return False
+            files = {}
+            for filename, (stat_key, digest, entries) in snapshot['files'].items():
+                file_path = Path(filename)
+                files[file_path] = (
+                    tuple(stat_key), digest, [self._load_entry(file_path, entry)
+                                       for entry in entries])
+        except FileNotFoundError:
+            return False
+        except Exception:
+            logging.exception('DynamicMacros: Ignoring unreadable snapshot %s', path)
+            return False
+        # Files already parsed by another instance are more recent
+        for file_path, cached in files.items():
+            self.file_cache.setdefault(file_path, cached)
+        return True
+
+    def save_snapshot(self, path):
+        # Entries are stored as plain JSON lists, so loading a snapshot never
+        # runs code and does not depend on the name of this module
+        files = {str(file_path): (stat_key, digest, [
+                    self._dump_entry(entry) for entry in entries])
+                 for file_path, (stat_key, digest, entries)
+                 in self.file_cache.items()}
+        write_atomic(path, json.dumps(
+            {'key': self.snapshot_key(), 'files': files},
+            separators=(',', ':')))
+
+    def _dump_entry(self, entry):
+        if isinstance(entry, ConfigInclude):
+            return ('include', entry.spec, entry.lineno)
+        return ('section', entry.name, entry.lineno, entry.options,
+                entry.linenos)
+
+    def _load_entry(self, path, entry):
+        if entry[0] == 'include':
+            return ConfigInclude(entry[1], path, entry[2])
+        section = ConfigSection(entry[1], path, entry[2])
+        section.options, section.linenos = entry[3], entry[4]
+        return section
+
+    def _glob_base(self, pattern):
+        # Deepest directory of a glob pattern without wildcards, where new
+        # matching files or directories can appear
+        base = Path(pattern).parent
+        while glob.has_magic(str(base)):
+            base = base.parent
+        return str(base)
+
+    def extract_macros(self, sections, previous={}):
         macros = {}
-        for section in config.sections():
-            logging.info(f'DynamicMacros: Reading section {section}')
-            if section.startswith('gcode_macro') or \
-                section.startswith('delayed_gcode'):
-                macro = DynamicMacro.from_section(
-                    config, section, DynamicMacros.printer, self.delimiter)
+        for section in sections.values():
+            logging.debug('DynamicMacros: Reading section %s', section.name)
+            if section.name.startswith('gcode_macro') or \
+                section.name.startswith('delayed_gcode'):
+                source_key = (section.name, tuple(section.items()))
+                macro = previous.get(section.name.split()[1])
+                if macro is None or macro.source_key != source_key:
+                    macro = DynamicMacro.from_section(
+                        section, DynamicMacros.printer, self.delimiter,
+                        source_key=source_key, **self.macro_options)
+                    self.stats['macros_built'] += 1
+                else:
+                    # Unchanged, but lines may have moved within the file
+                    macro.source_path = section.path
+                    macro.source_lines = array.array('I', section.gcode_lines())
+                    self.stats['macros_reused'] += 1
                 macros[macro.name] = macro
         return macros
 
-    def get_workaround_gcode(self, prev_gcode):
+    @staticmethod
+    def get_workaround_gcode(prev_gcode):
         lines = []
         for line in prev_gcode.splitlines():
             if '{% set ' in line and 'python' not in line:
@@ -93,6 +543,447 @@ class MacroConfigParser:
         compiled_gcode = '\n'.join(lines)
         return compiled_gcode
 
+class MacroFileWatcher:
+    # inotify(7) event flags
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+        | IN_CREATE | IN_DELETE
+    DEBOUNCE_TIME = 0.25
+
+    def __init__(self, printer, callback, poll_interval):
+        self.reactor = printer.get_reactor()
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.watched = set()
+        self.libc = None
+        self.inotify_fd = None
+        self.fd_handle = None
+        self.reload_timer = self.reactor.register_timer(self._reload_event)
+        self.poll_timer = None
+        if not self._setup_inotify():
+            logging.info('DynamicMacros: inotify unavailable, polling for changes')
+            self.poll_timer = self.reactor.register_timer(
+                self._poll_event, self.reactor.monotonic() + poll_interval)
+
+    def _setup_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return False
+        if fd < 0:
+            return False
+        self.libc = libc
+        self.inotify_fd = fd
+        self.fd_handle = self.reactor.register_fd(fd, self._handle_inotify)
+        return True
+
+    def watch(self, dirs):
+        if self.inotify_fd is None:
+            return
+        for path in set(dirs) - self.watched:
+            wd = self.libc.inotify_add_watch(
+                self.inotify_fd, os.fsencode(path), self.WATCH_MASK)
+            if wd < 0:
+                logging.info('DynamicMacros: Unable to watch %s', path)
+                continue
+            self.watched.add(path)
+
+    def _handle_inotify(self, eventtime):
+        try:
+            while os.read(self.inotify_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        # Editors often write a file in several steps, so wait for the
+        # events to settle before reloading
+        self.reactor.update_timer(
+            self.reload_timer, eventtime + self.DEBOUNCE_TIME)
+
+    def _reload_event(self, eventtime):
+        self.callback()
+        return self.reactor.NEVER
+
+    def _poll_event(self, eventtime):
+        self.callback()
+        return eventtime + self.poll_interval
+
+    def close(self):
+        if self.fd_handle is not None:
+            self.reactor.unregister_fd(self.fd_handle)
+            self.fd_handle = None
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+        if self.poll_timer is not None:
+            self.reactor.unregister_timer(self.poll_timer)
+            self.poll_timer = None
+        self.reactor.unregister_timer(self.reload_timer)
+
+class PythonTimeoutError(Exception):
+    pass
+
+class PythonBusyError(Exception):
+    pass
+
+class PythonExecutor:
+    # Runs python() blocks on worker threads while the reactor keeps
+    # running. Calls that must happen on the reactor thread (gcode, print,
+    # python) are handed back to it and the worker waits for their result.
+    # Everything else runs on the worker, including the `printer` object
+    # and the template's `printer` wrapper: their get_status() calls read
+    # printer state off the reactor thread.
+    def __init__(self, printer, workers, timeout):
+        self.reactor = printer.get_reactor()
+        self.workers = workers
+        self.timeout = timeout # 0 to wait forever
+        self.pool = None
+        self.running = set() # Futures holding a worker of self.pool
+        self.local = threading.local() # Set while running a worker's call
+
+    def execute(self, code, python_vars, reactor_calls):
+        # reactor_calls maps names to functions that must run on the
+        # reactor thread. A block started by one of those calls while every
+        # worker is busy could wait forever for its parent's worker, so it
+        # runs in place instead. Any other block is refused.
+        if len(self.running) >= self.workers:
+            if getattr(self.local, 'depth', 0):
+                python_vars.update(reactor_calls)
+                exec(code, python_vars)
+                return
+            raise PythonBusyError(
+                f'python() refused, all {self.workers} workers are busy')
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(
+                self.workers, thread_name_prefix='dynamicmacros-python')
+        call = {'active': True}
+        for name, func in reactor_calls.items():
+            python_vars[name] = self._wrap(func, call)
+        completion = self.reactor.completion()
+        running = self.running
+
+        def finished(future):
+            running.discard(future)
+            completion.complete(future)
+
+        future = self.pool.submit(exec, code, python_vars)
+        running.add(future)
+        future.add_done_callback(
+            lambda future: self.reactor.register_async_callback(
+                lambda eventtime: finished(future)))
+        waketime = self.reactor.NEVER
+        if self.timeout:
+            waketime = self.reactor.monotonic() + self.timeout
+        result = completion.wait(waketime)
+        call['active'] = False
+        if result is None:
+            # The worker cannot be stopped, so leave it (and the blocks still
+            # running next to it) to the old pool and start a new one
+            self._retire_pool()
+            raise PythonTimeoutError(
+                f'python() did not finish within {self.timeout:.1f}s')
+        result.result()
+
+    def _retire_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+        self.pool = None
+        self.running = set()
+
+    def _wrap(self, func, call):
+        # Worker side of a reactor call, blocks until the reactor ran it
+        def call_on_reactor(*args, **kwargs):
+            if not call['active']:
+                raise PythonTimeoutError('python() timed out, call dropped')
+            future = Future()
+
+            def callback(eventtime):
+                self.local.depth = getattr(self.local, 'depth', 0) + 1
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+                finally:
+                    self.local.depth -= 1
+            self.reactor.register_async_callback(callback)
+            return future.result()
+        return call_on_reactor
+
+    def close(self):
+        self._retire_pool()
+
+class GCodeBatch:
+    # Queues the commands of gcode() and print() in a python() block and
+    # hands them to the reactor `size` at a time, on flush() and when the
+    # block ends. Only the round trip is batched: commands are dispatched
+    # one by one, so an error names the python() line of the failing one.
+    def __init__(self, dispatch, size, python_vars):
+        self.dispatch = dispatch
+        self.size = size
+        self.python_vars = python_vars
+        self.lines = []
+        self.sources = [] # python() line of every queued command
+
+    def gcode(self, script):
+        self._queue(str(script), sys._getframe(1).f_lineno)
+
+    def print(self, *args):
+        self._queue('RESPOND MSG="' + ' '.join(map(str, args)) + '"',
+                    sys._getframe(1).f_lineno)
+
+    def _queue(self, line, lineno):
+        self.lines.append(line)
+        self.sources.append(lineno)
+        if len(self.lines) >= self.size:
+            # The block's own flush(), which is handed to the reactor
+            # thread when the block runs on a worker
+            self.python_vars['flush']()
+
+    def flush(self):
+        if not self.lines:
+            return
+        lines, sources = self.lines, self.sources
+        self.lines, self.sources = [], []
+        for line, lineno in zip(lines, sources):
+            try:
+                self.dispatch(line)
+            except Exception as e:
+                try:
+                    located = type(e)(
+                        f'{str(e).rstrip()} (queued by python() line {lineno})')
+                except Exception:
+                    raise e
+                raise located from e
+
+class VariableStore:
+    # Macro variables set with SET_DYNAMIC_VARIABLE, read once at startup.
+    # Updates only touch memory; a timer writes them out in one go.
+    def __init__(self, printer, path, flush_interval):
+        self.reactor = printer.get_reactor()
+        self.path = path
+        self.flush_interval = flush_interval
+        self.dirty = False
+        self.data = {}
+        try:
+            with open(path, 'r') as file:
+                self.data = json.load(file)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logging.exception('DynamicMacros: Unable to read variable store %s', path)
+        self.flush_timer = self.reactor.register_timer(self._flush_event)
+
+    @classmethod
+    def get_store(cls, printer, path, flush_interval):
+        # Instances that name the same file share one store
+        stores = variable_stores.setdefault(printer, {})
+        if path not in stores:
+            stores[path] = cls(printer, path, flush_interval)
+        return stores[path]
+
+    def get(self, macro_name):
+        return self.data.get(macro_name.upper(), {})
+
+    def set(self, macro_name, variable, value):
+        self.data.setdefault(macro_name.upper(), {})[variable] = value
+        if not self.dirty:
+            self.dirty = True
+            self.reactor.update_timer(
+                self.flush_timer, self.reactor.monotonic() + self.flush_interval)
+
+    def _flush_event(self, eventtime):
+        self.flush()
+        return self.reactor.NEVER
+
+    def flush(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        self.reactor.update_timer(self.flush_timer, self.reactor.NEVER)
+        try:
+            write_atomic(self.path, json.dumps(self.data, indent=2, sort_keys=True))
+        except OSError:
+            logging.exception('DynamicMacros: Unable to write variable store %s', self.path)
+
+class WorkaroundWriter:
+    # Collects the interface workaround sections of the main instance and
+    # every cluster into .dynamicmacros.cfg. Each instance rewrites the file
+    # as it loads, keeping the sections of instances not loaded yet, so a
+    # file Klipper rejects is fixed for the next restart even when
+    # klippy:connect is never reached. On connect the file is written once
+    # more with only the loaded instances. Files are only rewritten when
+    # their content changes.
+    INCLUDE_STATEMENT = '[include .dynamicmacros.cfg]'
+    BLOCK_HEADER = '# Dynamic Macros: '
+
+    def __init__(self, printer):
+        self.blocks = {} # 'main' or 'cluster <name>' -> sections
+        printer.register_event_handler('klippy:connect', self._handle_connect)
+
+    @classmethod
+    def get_writer(cls, printer):
+        if printer not in workaround_writers:
+            workaround_writers[printer] = cls(printer)
+        return workaround_writers[printer]
+
+    def add(self, cluster, cfg):
+        label = 'main' if cluster is None else f'cluster {cluster}'
+        self.blocks[label] = f'{self.BLOCK_HEADER}{label}\n{cfg}'
+        try:
+            self.write(self._read_blocks())
+        except OSError:
+            logging.exception('DynamicMacros: Unable to write the interface workaround')
+
+    def _handle_connect(self):
+        try:
+            self.write()
+        except OSError:
+            logging.exception('DynamicMacros: Unable to write the interface workaround')
+
+    def _read_blocks(self):
+        # Blocks of the current file by label, sections before the first
+        # header (written by older versions) are dropped
+        blocks = {}
+        label = None
+        try:
+            with open(config_path / '.dynamicmacros.cfg', 'r') as file:
+                for line in file:
+                    if line.startswith(self.BLOCK_HEADER):
+                        label = line[len(self.BLOCK_HEADER):].strip()
+                        blocks[label] = ''
+                    if label is not None:
+                        blocks[label] += line
+        except OSError:
+            pass
+        return blocks
+
+    def write(self, kept={}):
+        content = ''.join({**kept, **self.blocks}.values())
+        path = config_path / '.dynamicmacros.cfg'
+        try:
+            current = hashlib.sha1(path.read_bytes()).digest()
+        except OSError:
+            current = None
+        if hashlib.sha1(content.encode()).digest() != current:
+            write_atomic(path, content)
+        self._add_include()
+
+    def _add_include(self):
+        # Update printer.cfg to [include .dynamicmacros.cfg]
+        path = config_path / 'printer.cfg'
+        with open(path, 'r') as file:
+            lines = file.readlines()
+        for line in lines:
+            if len(line.strip()) < 1:
+                # Ignore empty lines
+                continue
+            if line.strip()[0] in ('#', ';', '//'):
+                # Ignore comments
+                continue
+            if self.INCLUDE_STATEMENT in line:
+                return
+        lines.insert(0, self.INCLUDE_STATEMENT + '\n')
+        write_atomic(path, ''.join(lines))
+
+class MacroScheduler:
+    # Runs delayed macros from a single reactor timer. Deadlines are kept in
+    # a min-heap and state is keyed by macro name, so a macro rebuilt by a
+    # reload keeps its schedule.
+    def __init__(self, printer):
+        self.reactor = printer.get_reactor()
+        self.timer = self.reactor.register_timer(self._timer_event)
+        self.macros = {} # name -> macro
+        self.state = {} # name -> {'duration': ..., 'repeat': ...}
+        self.deadlines = {} # name -> (waketime, serial) of its heap entry
+        self.heap = [] # (waketime, serial, name), outdated entries skipped
+        self.serial = 0
+        self.running = None # Name of the macro run by the timer
+        self.ready = False
+
+    def start(self):
+        self.ready = True
+        for name, state in self.state.items():
+            self.schedule(name, state['duration'])
+
+    def add(self, macro):
+        name = macro.name.upper()
+        self.macros[name] = macro
+        if name not in self.state:
+            self.state[name] = {'duration': macro.duration or 0.,
+                                'repeat': macro.repeat}
+            if self.ready:
+                self.schedule(name, macro.duration)
+
+    def remove(self, name):
+        self.macros.pop(name, None)
+        self.state.pop(name, None)
+        if self.deadlines.pop(name, None) is not None:
+            self._update_timer()
+
+    def schedule(self, name, duration):
+        if duration:
+            self._push(name, self.reactor.monotonic() + duration)
+        else:
+            self.deadlines.pop(name, None)
+        self._update_timer()
+
+    def _push(self, name, waketime):
+        self.serial += 1
+        self.deadlines[name] = (waketime, self.serial)
+        heapq.heappush(self.heap, (waketime, self.serial, name))
+        # Drop outdated entries once they outnumber the live ones
+        if len(self.heap) > 2 * len(self.deadlines) + 16:
+            self.heap = [(waketime, serial, name) for name, (waketime, serial)
+                         in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def _next_waketime(self):
+        heap = self.heap
+        while heap and self.deadlines.get(heap[0][2]) != heap[0][:2]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else self.reactor.NEVER
+
+    def _update_timer(self):
+        # While the timer runs a macro, its return value sets the next wake
+        if self.running is None:
+            self.reactor.update_timer(self.timer, self._next_waketime())
+
+    def _timer_event(self, eventtime):
+        while self._next_waketime() <= eventtime:
+            name = heapq.heappop(self.heap)[2]
+            del self.deadlines[name]
+            self._run(name, eventtime)
+        return self._next_waketime()
+
+    def _run(self, name, eventtime):
+        self.running = name
+        try:
+            self.macros[name].run({}, '')
+        except Exception:
+            logging.exception('DynamicMacros: Delayed macro %s failed', name)
+        finally:
+            self.running = None
+        state = self.state.get(name)
+        if state is not None and state['repeat'] and name not in self.deadlines:
+            self._push(name, eventtime + state['duration'])
+
+    # Handle UPDATE_DELAYED_GCODE command
+    def cmd_UPDATE_DELAYED_GCODE(self, gcmd):
+        name = gcmd.get('ID').upper()
+        state = self.state.get(name)
+        if state is None:
+            raise gcmd.error('Not a [delayed_gcode]!')
+        state['duration'] = gcmd.get_float('DURATION', minval=0)
+        if name == self.running:
+            state['repeat'] = (state['duration'] != 0.)
+        else:
+            self.schedule(name, state['duration'])
+
 class MissingConfigError(Exception):
     pass
 
@@ -111,6 +1002,10 @@ class DynamicMacros:
         self.fnames = config.getlist('configs')
 
         self.delimiter = config.get('delimiter', '---')
+        self.reload_mode = config.getchoice(
+            'reload_mode', {'command': 'command', 'watch': 'watch'}, 'command')
+        self.watch_interval = config.getfloat('watch_interval', 1., above=0.)
+        self.watcher = None
 
         if is_cluster:
             self.name = config.get_name().split()[1]
@@ -118,7 +1013,7 @@ class DynamicMacros:
             self.python_enabled = config.getboolean('python_enabled', True)
             self.printer_enabled = config.getboolean('printer_enabled', True)
         else:
-            self._setup_logging()
+            self._setup_logging(config)
             DynamicMacros.printer = self.printer
 
             # Register commands
@@ -127,14 +1022,71 @@ class DynamicMacros:
             self.gcode.register_command(
                 'DYNAMIC_RENDER', self.cmd_DYNAMIC_RENDER, desc='Render a Dynamic Macro')
             self.gcode.register_command('SET_DYNAMIC_VARIABLE', self.cmd_SET_DYNAMIC_VARIABLE, desc="Set the variable of a Dynamic Macro.")
+            self.gcode.register_command(
+                'DYNAMIC_MACRO_STATS', self.cmd_DYNAMIC_MACRO_STATS, desc='Report Dynamic Macro runtime statistics')
+            self.gcode.register_command(
+                'DYNAMIC_MACRO_PROFILE', self.cmd_DYNAMIC_MACRO_PROFILE, desc='Profile a Dynamic Macro')
+
+        self.configfile = self.printer.lookup_object('configfile')
+        self.workaround_config = self._install_status_hook()
+
+        cache_dir = os.path.join(
+            os.path.dirname(self.printer.start_args['config_file']),
+            '.dynamicmacros_cache')
+        bytecode_dir = None
+        if config.getboolean('bytecode_cache', False):
+            bytecode_dir = cache_dir
+        self.env = get_jinja_env(
+            bytecode_dir, config.getint('template_cache_size', 512, minval=0))
+        macro_options = {
+            'env': self.env,
+            'lazy': config.getboolean('lazy_compile', False),
+            'max_variables': config.getint('max_variables', 0, minval=0),
+            'python_executor': None,
+            'render_cache_size': config.getint('render_cache_size', 16, minval=1),
+            'stream_batch': config.getint('stream_batch_lines', 100, minval=1),
+            'python_batch': config.getint('python_batch_lines', 0, minval=0),
+        }
+        # Opt-in: run python() blocks on worker threads
+        self.python_executor = None
+        if config.getboolean('python_async', False):
+            self.python_executor = PythonExecutor(
+                self.printer, config.getint('python_workers', 2, minval=1),
+                config.getfloat('python_timeout', 30., minval=0.))
+            macro_options['python_executor'] = self.python_executor
+        self.warmup = [name.upper() for name in config.getlist('warmup', [])]
+
+        # Opt-in: keep SET_DYNAMIC_VARIABLE values across reloads and restarts
+        self.variable_store = None
+        store_file = config.get('variable_store', None)
+        if store_file is not None:
+            store_path = os.path.join(
+                os.path.dirname(self.printer.start_args['config_file']),
+                os.path.expanduser(store_file))
+            self.variable_store = VariableStore.get_store(
+                self.printer, store_path,
+                config.getfloat('variable_store_interval', 5., above=0.))
 
         self.macros = {}
+        self.owners = macro_owners.setdefault(self.printer, {})
+        self.scheduler = MacroScheduler(self.printer)
+        self.reload_stats = {'count': 0, 'total_time': 0., 'last_time': 0.,
+                             'max_time': 0.}
         self.placeholder = DynamicMacro(
-            'Error', 'RESPOND MSG="ERROR"', self.printer)
+            'Error', 'RESPOND MSG="ERROR"', self.printer, **macro_options)
 
-        self.configfile = self.printer.lookup_object('configfile')
+        self.config_parser = MacroConfigParser(
+            self.printer, self.delimiter, macro_options)
 
-        self.config_parser = MacroConfigParser(self.printer, self.delimiter)
+        # Opt-in: start from the files parsed by the previous run
+        self.snapshot_path = None
+        self.snapshot_misses = None
+        if config.getboolean('startup_snapshot', False):
+            os.makedirs(cache_dir, exist_ok=True)
+            self.snapshot_path = os.path.join(
+                cache_dir, f"snapshot-{getattr(self, 'name', 'main')}.json")
+            if self.config_parser.load_snapshot(self.snapshot_path):
+                self.snapshot_misses = 0
 
         # Interface workaround
         # - Allows macros to display on KlipperScreen
@@ -147,22 +1099,11 @@ class DynamicMacros:
         self.reactor = self.printer.get_reactor()
         self.printer.register_event_handler(
             "klippy:ready", self._handle_ready)
+        self.printer.register_event_handler(
+            "klippy:disconnect", self._handle_disconnect)
 
-    def _setup_logging(self):
-        # Get git short version hash
-        try:
-            result = subprocess.run(
-                ['git', 'rev-parse', '--short', 'HEAD'],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.DEVNULL,
-                text=True,
-                check=True,
-                cwd=DYNAMICMACROS_PATH
-            )
-            git_hash = result.stdout.strip()
-        except subprocess.CalledProcessError:
-            git_hash = 'unknown'
-
+    def _setup_logging(self, config):
+        global logger
         # Setup logging
         if not globals().get('LOG_SETUP', False):
             logger = logging.Logger('DynamicMacros')
@@ -172,22 +1113,83 @@ class DynamicMacros:
             handler = logging.FileHandler(mimo_log, mode='w')
             formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
             handler.setFormatter(formatter)
-            logger.addHandler(handler)
+            # The file is written from a background thread, so a slow disk
+            # never blocks the reactor
+            log_queue = queue.Queue()
+            listener = QueueListener(log_queue, handler)
+            listener.start()
+            atexit.register(listener.stop)
+            logger.addHandler(QueueHandler(log_queue))
+            logger.addFilter(RateLimitFilter())
             logger.setLevel(logging.DEBUG)
             globals()['logging'] = logger
             globals()['LOG_SETUP'] = True
             logger.info('DynamicMacros Startup')
-            logger.info(f'Git version: {git_hash}')
+            logger.info('Git version: %s', self._git_version())
+
+        # The logger outlives a RESTART, its settings are applied every time
+        logger.setLevel(LOG_LEVELS[config.getchoice(
+            'log_level', {level: level for level in LOG_LEVELS}, 'info')])
+        for log_filter in logger.filters:
+            if isinstance(log_filter, RateLimitFilter):
+                log_filter.limit = config.getint('log_rate_limit', 20, minval=0)
+
+    def _git_version(self):
+        # Get git short version hash from the checkout itself, without
+        # running git, so it is current after any update
+        git_dir = DYNAMICMACROS_PATH / '.git'
+        try:
+            if git_dir.is_file(): # Worktree or submodule
+                gitdir = git_dir.read_text().strip()
+                git_dir = DYNAMICMACROS_PATH / gitdir[len('gitdir:'):].strip()
+            head = (git_dir / 'HEAD').read_text().strip()
+            if not head.startswith('ref:'):
+                return head[:7] # Detached HEAD
+            ref = head[len('ref:'):].strip()
+            common_dir = git_dir
+            if (git_dir / 'commondir').is_file():
+                common_dir = git_dir / (git_dir / 'commondir').read_text().strip()
+            for ref_dir in (git_dir, common_dir):
+                if (ref_dir / ref).is_file():
+                    return (ref_dir / ref).read_text().strip()[:7]
+            with open(common_dir / 'packed-refs', 'r') as file:
+                for line in file:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] == ref:
+                        return parts[0][:7]
+        except OSError:
+            pass
+        return 'unknown'
 
     def _handle_ready(self):
-        self._update_macros()
-        waketime = self.reactor.monotonic() + 1
-        self.timer_handler = self.reactor.register_timer(
-            self._gcode_timer_event, waketime)
-
-    def _gcode_timer_event(self, eventtime):
-        self._update_macros()
-        return self.reactor.NEVER
+        # The macros loaded at startup are still current; they only need to
+        # take back commands claimed by [gcode_macro] sections meanwhile, so
+        # unregister and register them again in one batch
+        macros = list(self.macros.values())
+        self.apply_macro_changes(macros, macros)
+        self.scheduler.start()
+        if self.reload_mode == 'watch':
+            self.watcher = MacroFileWatcher(
+                self.printer, self._watch_reload, self.watch_interval)
+            self.watcher.watch(self.config_parser.watch_dirs)
+
+    def _handle_disconnect(self):
+        if self.variable_store is not None:
+            self.variable_store.flush()
+        if self.python_executor is not None:
+            self.python_executor.close()
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+    def _watch_reload(self):
+        # Runs from a reactor callback, so errors must not propagate
+        try:
+            self._update_macros()
+        except Exception as e:
+            logging.exception('DynamicMacros: Reload failed')
+            self.gcode.respond_info(f'DynamicMacros reload failed: {e}')
+        self.watcher.watch(self.config_parser.watch_dirs)
 
     def interface_workaround(self):
         full_cfg = StringIO()
@@ -208,36 +1210,80 @@ class DynamicMacros:
                 # Only [delayed_gcode] sections should have initial_duration
                 if cfg.has_option(section, 'initial_duration') and not section.startswith('delayed_gcode'):
                     cfg.remove_option(section, 'initial_duration')
+                # Klipper rejects options only Dynamic Macros knows about
+                for option in ('cache', 'stream'):
+                    cfg.remove_option(section, option)
 
             cfg.write(full_cfg)
 
-        # Write cfg to config_path/.dynamicmacros.cfg
-        with open(config_path / '.dynamicmacros.cfg', 'w+') as file:
-            file.write(full_cfg.getvalue())
+        writer = WorkaroundWriter.get_writer(self.printer)
+        writer.add(getattr(self, 'name', None), full_cfg.getvalue())
 
-        # Update printer.cfg to [include .dynamicmacros.cfg]
-        include_statement = '[include .dynamicmacros.cfg]'
-        with open(config_path / 'printer.cfg', 'r') as file:
-            lines = file.readlines()
-            found = False
-            for line in lines:
-                if len(line.strip()) < 1:
-                    # Ignore empty lines
-                    continue
-                if line.strip()[0] in ('#', ';', '//'):
-                    # Ignore comments
-                    continue
-                if include_statement in line:
-                    found = True
-                    break
-            if not found:
-                lines.insert(0, include_statement+'\n')
+    def register_macro(self, macro):
+        self.apply_macro_changes([], [macro])
 
-        with open(config_path / 'printer.cfg', 'w+') as file:
-            file.writelines(lines)
+    def unregister_macro(self, macro):
+        self.apply_macro_changes([macro], [])
+
+    def apply_macro_changes(self, removed, added):
+        # Apply the (un)registrations of a whole reload as one batch: the
+        # gcode status commands are rebuilt once at the end, and if any macro
+        # fails to register the previous set of macros is restored
+        previous = list(self.macros.values())
+        unregistered = []
+        registered = []
+        with self._batched_status_commands():
+            try:
+                for macro in removed:
+                    self._unregister_macro(macro)
+                    unregistered.append(macro)
+                for macro in added:
+                    registered.append(macro)
+                    self._register_macro(macro)
+            except Exception:
+                logging.exception('DynamicMacros: Registration failed, rolling back')
+                for macro in reversed(registered):
+                    self._unregister_macro(macro)
+                for macro in previous:
+                    if self.macros.get(macro.name.upper()) is not macro:
+                        self._register_macro(macro)
+                raise
+        # Schedules follow the macro name, so a rebuilt macro keeps its own
+        names = set()
+        for macro in registered:
+            names.add(macro.name.upper())
+            if macro.is_delayed_gcode or macro.duration:
+                self.scheduler.add(macro)
+            else:
+                self.scheduler.remove(macro.name.upper())
+        for macro in unregistered:
+            if macro.name.upper() not in names:
+                self.scheduler.remove(macro.name.upper())
+
+    @contextlib.contextmanager
+    def _batched_status_commands(self):
+        gcode = self.gcode
+        shadowed = '_build_status_commands' in vars(gcode)
+        build_status_commands = gcode._build_status_commands
+        gcode._build_status_commands = lambda: None
+        try:
+            yield
+        finally:
+            if shadowed:
+                gcode._build_status_commands = build_status_commands
+            else:
+                del gcode._build_status_commands
+            build_status_commands()
 
-    def register_macro(self, macro):
+    def _register_macro(self, macro):
         self.macros[macro.name.upper()] = macro
+        # The main instance comes first, then clusters in registration order
+        owners = self.owners.setdefault(macro.name.upper(), [])
+        if self not in owners:
+            owners.insert(len(owners) if hasattr(self, 'name') else 0, self)
+        if self.variable_store is not None:
+            macro.variables.update(self.variable_store.get(macro.name))
+            macro.version += 1
         if (macro.name not in self.gcode.ready_gcode_handlers) and (macro.name not in self.gcode.base_gcode_handlers):
             _ = self.gcode.register_command(macro.name.upper(), None, desc=macro.desc)
             self.gcode.register_command(
@@ -249,26 +1295,31 @@ class DynamicMacros:
                     prev_values[macro.name] = None
                     del prev_values[macro.name]
                 self.gcode.register_mux_command(
-                    'UPDATE_DELAYED_GCODE', 'ID', macro.name, macro.cmd_UPDATE_DELAYED_GCODE)
-            self.gcode._build_status_commands()
+                    'UPDATE_DELAYED_GCODE', 'ID', macro.name, self.scheduler.cmd_UPDATE_DELAYED_GCODE)
             self.printer.objects[f'gcode_macro {macro.name}'] = macro
-            # self.configfile.status_raw_config[f'gcode_macro {macro.name}'] = macro.get_status()
-            original_get_status = self.configfile.get_status
-            def get_status(eventtime):
-                status = original_get_status(eventtime)
-                config = status['config']
-                workaround_gcode = self.config_parser.get_workaround_gcode(macro.raw)
-                config.update({f'gcode_macro {macro.name}': {'gcode': workaround_gcode}})
-                status.update({'config': config})
+            workaround_gcode = macro.workaround_gcode
+            self.workaround_config[f'gcode_macro {macro.name}'] = {
+                'gcode': workaround_gcode}
+
+    def _install_status_hook(self):
+        # A single configfile.get_status hook is shared by the main instance
+        # and every cluster; registration only updates its overrides
+        get_status = self.configfile.get_status
+        overrides = getattr(get_status, 'workaround_config', None)
+        if overrides is None:
+            overrides = {}
+            def hooked_get_status(eventtime):
+                status = get_status(eventtime)
+                status['config'] = {**status['config'], **overrides}
                 return status
-            self.configfile.get_status = get_status
+            hooked_get_status.workaround_config = overrides
+            self.configfile.get_status = hooked_get_status
+        return overrides
 
     def cmd_SET_DYNAMIC_VARIABLE(self, gcmd):
-        macro = gcmd.get('MACRO').upper()
-        if macro not in self.macros:
-            for name, cluster in self.clusters.items():
-                if macro in cluster.macros:
-                    return cluster._cmd_SET_DYNAMIC_VARIABLE(gcmd)
+        owners = self.owners.get(gcmd.get('MACRO').upper())
+        if owners:
+            return owners[0]._cmd_SET_DYNAMIC_VARIABLE(gcmd)
         return self._cmd_SET_DYNAMIC_VARIABLE(gcmd)
 
     def _cmd_SET_DYNAMIC_VARIABLE(self, gcmd):
@@ -286,18 +1337,25 @@ class DynamicMacros:
             macro = self.macros.get(name.upper())
             if macro:
                 macro.variables[variable] = literal
+                macro.version += 1
+                if self.variable_store is not None:
+                    self.variable_store.set(macro.name, variable, literal)
             else:
                 self.gcode.respond_info(f'ERROR: Macro {name} not found!')
 
-    def unregister_macro(self, macro):
-        macro.repeat = False
+    def _unregister_macro(self, macro):
         self.gcode.register_command(macro.name.upper(), None)
         if macro.is_delayed_gcode:
-            _, vals = self.gcode.mux_commands.get('UPDATE_DELAYED_GCODE')
-            if macro.name in vals:
-                del vals[macro.name]
-        self.gcode._build_status_commands()
+            prev = self.gcode.mux_commands.get('UPDATE_DELAYED_GCODE')
+            if prev is not None and macro.name in prev[1]:
+                del prev[1][macro.name]
         self.macros.pop(macro.name.upper(), None)
+        owners = self.owners.get(macro.name.upper(), [])
+        if self in owners:
+            owners.remove(self)
+            if not owners:
+                del self.owners[macro.name.upper()]
+        self.workaround_config.pop(f'gcode_macro {macro.name}', None)
 
     def cmd_DYNAMIC_RENDER(self, gcmd):
         cluster = gcmd.get('CLUSTER', None)
@@ -308,9 +1366,6 @@ class DynamicMacros:
     def _cmd_DYNAMIC_RENDER(self, gcmd):
         try:
             # self._update_macros()
-            logging.info('DynamicMacros Macros:')
-            for name in self.macros:
-                logging.info(f'    Name: {name}')
             macro_name = gcmd.get('MACRO', '').upper()
             if macro_name:
                 params = gcmd.get_command_parameters()
@@ -323,10 +1378,14 @@ class DynamicMacros:
             gcmd.respond_info(str(e))
 
     def _render_macro(self, macro, params, rawparams):
-        rendered = []
-        for template in macro.templates:
-            macro.update_kwparams(template, params, rawparams)
-            rendered.append(template.template.render(macro.kwparams))
+        rendered = macro.cached_scripts(params, rawparams)
+        if rendered is None:
+            rendered = []
+            context = macro.create_context(params, rawparams)
+            for index, template in enumerate(macro.templates):
+                macro.kwparams = macro.refresh_context(context, template)
+                rendered.append(macro.render(template, index))
+            macro.cache_scripts(params, rawparams, rendered)
         return '\n'.join(rendered)
 
     def cmd_DYNAMIC_MACRO(self, gcmd):
@@ -338,11 +1397,9 @@ class DynamicMacros:
 
     def _cmd_DYNAMIC_MACRO(self, gcmd):
         try:
-            self._update_macros()
-            logging.info('DynamicMacros Macros:')
-            for name in self.macros:
-                logging.info(f'    Name: {name}')
-            macro_name = gcmd.get('MACRO', '')
+            if self.reload_mode == 'command':
+                self._update_macros()
+            macro_name = gcmd.get('MACRO', '').upper()
             if macro_name:
                 params = gcmd.get_command_parameters()
                 rawparams = gcmd.get_raw_command_parameters()
@@ -362,26 +1419,169 @@ class DynamicMacros:
         macro.run(params, rawparams)
 
     def _update_macros(self):
-        self._unregister_all_macros()
-        self._load_and_register_macros_from_files()
-
-    def _unregister_all_macros(self):
-        for macro in list(self.macros.values()):
-            self.unregister_macro(macro)
+        # Only added, removed or changed macros are (un)registered
+        start = time.perf_counter()
+        new_macros = self._load_macros_from_files()
+        removed = [macro for name, macro in self.macros.items()
+                   if new_macros.get(name) is not macro]
+        added = [macro for name, macro in new_macros.items()
+                 if self.macros.get(name) is not macro]
+        if removed or added:
+            self.apply_macro_changes(removed, added)
+            logging.debug('DynamicMacros Macros: %s', ', '.join(self.macros))
+        self._warm_up(added)
+        self._save_snapshot()
+        elapsed = time.perf_counter() - start
+        stats = self.reload_stats
+        stats['count'] += 1
+        stats['total_time'] += elapsed
+        stats['last_time'] = elapsed
+        stats['max_time'] = max(stats['max_time'], elapsed)
+
+    def _save_snapshot(self):
+        # Only written when a file had to be parsed again
+        misses = self.config_parser.stats['file_misses']
+        if self.snapshot_path is None or misses == self.snapshot_misses:
+            return
+        try:
+            self.config_parser.save_snapshot(self.snapshot_path)
+            self.snapshot_misses = misses
+        except OSError:
+            logging.exception('DynamicMacros: Unable to write startup snapshot')
 
-    def _load_and_register_macros_from_files(self):
-        for fname in self.fnames:
-            self._load_and_register_macros_from_file(fname)
+    def _warm_up(self, macros):
+        # Compile the templates of hot macros ahead of their first use
+        for macro in macros:
+            if macro.name.upper() in self.warmup:
+                macro.templates
 
-    def _load_and_register_macros_from_file(self, fname):
-        config = self.config_parser.read_config_file(fname)
-        new_macros = self.config_parser.extract_macros(config)
-        self._register_new_macros(new_macros)
+    def get_status(self, eventtime=None):
+        template_cache = self.env.template_cache
+        cache = {**self.config_parser.stats,
+                 'template_hits': template_cache.hits,
+                 'template_misses': template_cache.misses}
+        macros = {name: macro.stats.get_status()
+                  for name, macro in self.macros.items()}
+        return {'reload': dict(self.reload_stats), 'cache': cache,
+                'macros': macros}
+
+    def cmd_DYNAMIC_MACRO_STATS(self, gcmd):
+        count = gcmd.get_int('COUNT', 10, minval=1)
+        sort = gcmd.get('SORT', 'total').lower()
+        if sort not in MacroStats.SORT_KEYS:
+            raise gcmd.error(f'SORT must be one of {", ".join(MacroStats.SORT_KEYS)}')
+        instances = [(None, self)] + list(self.clusters.items())
+        if gcmd.get_int('RESET', 0):
+            for _, instance in instances:
+                for macro in instance.macros.values():
+                    macro.stats.reset()
+            gcmd.respond_info('Dynamic Macro statistics reset')
+            return
+        entries = []
+        for cluster, instance in instances:
+            for macro in instance.macros.values():
+                if macro.stats.count:
+                    label = f'{cluster}:{macro.name}' if cluster else macro.name
+                    entries.append((label, macro.stats))
+        entries.sort(key=lambda entry: entry[1].sort_key(sort), reverse=True)
+        lines = [f'Dynamic Macros by {sort} time:' if sort != 'count'
+                 else 'Dynamic Macros by call count:']
+        for label, stats in entries[:count]:
+            lines.append(f'{label}: {stats.summary()}')
+        if not entries:
+            lines.append('No Dynamic Macros have run yet')
+        for cluster, instance in instances:
+            reload = instance.reload_stats
+            lines.append(
+                f'Reloads{" (" + cluster + ")" if cluster else ""}: '
+                f'{reload["count"]}, last {reload["last_time"] * 1000:.2f}ms, '
+                f'max {reload["max_time"] * 1000:.2f}ms')
+        gcmd.respond_info('\n'.join(lines))
+
+    def cmd_DYNAMIC_MACRO_PROFILE(self, gcmd):
+        cluster = gcmd.get('CLUSTER', None)
+        instance = self.clusters.get(cluster, self) if cluster else self
+        name = gcmd.get('MACRO').upper()
+        macro = instance.macros.get(name)
+        if macro is None:
+            raise gcmd.error(f'Macro {name} not found')
+        runs = gcmd.get_int('RUNS', 1, minval=1)
+        dry_run = gcmd.get_int('DRY_RUN', 1)
+        count = gcmd.get_int('LINES', 10, minval=1)
+        params = gcmd.get_command_parameters()
+        rawparams = gcmd.get_raw_command_parameters()
+
+        # By default only render, so profiling never moves the toolhead
+        if dry_run:
+            target = lambda: instance._render_macro(macro, params, rawparams)
+        else:
+            target = lambda: macro.run(params, rawparams)
+        profiler = cProfile.Profile()
+        line_timer = LineTimer(macro)
+        start = time.perf_counter()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            raise gcmd.error(f'Unable to start the profiler: {e}')
+        sys.settrace(line_timer.trace)
+        try:
+            for _ in range(runs):
+                target()
+        finally:
+            sys.settrace(None)
+            profiler.disable()
+        elapsed = time.perf_counter() - start
+
+        log_dir = os.path.dirname(self.printer.start_args['log_file'])
+        path = os.path.join(log_dir, f'dynamicmacros-{macro.name}.prof')
+        profiler.dump_stats(path)
+
+        totals = self._profile_totals(profiler, macro)
+        lines = [f'Profile of {macro.name}, {runs} {"dry " if dry_run else ""}'
+                 f'run{"s" if runs > 1 else ""}, {elapsed / runs * 1000:.2f}ms per run '
+                 f'(with profiling overhead)',
+                 'Per run, inclusive: ' + ', '.join(
+                     f'{category} {total / runs * 1000:.2f}ms'
+                     for category, total in totals.items())]
+        slowest = line_timer.slowest(count)
+        if slowest:
+            lines.append('Slowest lines, per run:')
+            for location, total in slowest:
+                lines.append(f'  {location}: {total / runs * 1000:.3f}ms')
+        lines.append(f'Profile written to {path}')
+        gcmd.respond_info('\n'.join(lines))
+
+    def _profile_totals(self, profiler, macro):
+        # Cumulative time of the functions that mark each category
+        printer = macro.templates[0].create_template_context()['printer']
+        categories = {
+            'render': [stream_template],
+            'python()': [DynamicMacro.python],
+            'printer lookups': [getattr(type(printer), '__getitem__', None),
+                                getattr(type(printer), '__contains__', None),
+                                type(self.printer).lookup_object],
+            'dispatch': [type(self.gcode).run_script_from_command],
+        }
+        stats = pstats.Stats(profiler).stats
+        totals = {}
+        for category, functions in categories.items():
+            totals[category] = 0.
+            for function in functions:
+                code = getattr(function, '__code__', None)
+                if code is None:
+                    continue
+                key = (code.co_filename, code.co_firstlineno, code.co_name)
+                if key in stats:
+                    totals[category] += stats[key][3]
+        return totals
 
-    def _register_new_macros(self, new_macros):
-        for name, macro in new_macros.items():
-            self.macros[name] = macro
-            self.register_macro(macro)
+    def _load_macros_from_files(self):
+        new_macros = {}
+        for fname in self.fnames:
+            macros = self.config_parser.read_macros(fname)
+            for macro in macros.values():
+                new_macros[macro.name.upper()] = macro
+        return new_macros
 
 
 class DynamicMacrosCluster(DynamicMacros):
@@ -396,24 +1596,175 @@ class DynamicMacrosCluster(DynamicMacros):
                 f'{name} has been blocked from performing a disabled task.')
         return func
 
-    def sandboxed_kwparams(self, macro):
-        def func(template, params, rawparams):
-            macro._update_kwparams(template, params, rawparams)
-            if not self.python_enabled:
-                macro.kwparams['python'] = self.disabled_func(
-                    macro.name, 'run Python code')
-                macro.kwparams['python_file'] = self.disabled_func(
-                    macro.name, 'run Python file')
-            if not self.printer_enabled:
-                macro.kwparams['printer'] = None
-        return func
-
-    def _run_macro(self, macro, params, rawparams):
-        macro.update_kwparams = self.sandboxed_kwparams(macro)
-        macro.run(params, rawparams)
-
+    def sandbox_overrides(self, macro):
+        overrides = {}
+        if not self.python_enabled:
+            overrides['python'] = self.disabled_func(
+                macro.name, 'run Python code')
+            overrides['python_file'] = self.disabled_func(
+                macro.name, 'run Python file')
+        if not self.printer_enabled:
+            overrides['printer'] = None
+        return overrides
+
+    def _register_macro(self, macro):
+        macro.overrides = self.sandbox_overrides(macro)
+        super()._register_macro(macro)
+
+
+class LineTimer:
+    # Inclusive time spent on each line of a macro's templates and of the
+    # python() blocks and files it runs, collected through sys.settrace
+    def __init__(self, macro):
+        self.macro = macro
+        self.templates = {} # code -> (chunk index, Jinja template)
+        for index, template in enumerate(macro.templates):
+            jinja_template = template.template
+            functions = [jinja_template.root_render_func,
+                         *jinja_template.blocks.values()]
+            codes = [function.__code__ for function in functions]
+            while codes:
+                code = codes.pop()
+                self.templates[code] = (index, jinja_template)
+                codes.extend(const for const in code.co_consts
+                             if isinstance(const, types.CodeType))
+        self.followed = {} # filename -> whether its lines are timed
+        self.current = {} # frame -> (line, start time)
+        self.times = {} # (code, line) -> seconds
+
+    def trace(self, frame, event, arg):
+        filename = frame.f_code.co_filename
+        followed = self.followed.get(filename)
+        if followed is None:
+            followed = self.followed[filename] = (
+                filename == '<template>' or filename.startswith('<python ')
+                or filename in {str(key[0]) for key in python_file_cache})
+        return self.trace_lines if followed else None
+
+    def trace_lines(self, frame, event, arg):
+        now = time.perf_counter()
+        if event in ('line', 'return'):
+            current = self.current.pop(frame, None)
+            if current is not None:
+                key = (frame.f_code, current[0])
+                self.times[key] = self.times.get(key, 0.) + now - current[1]
+            if event == 'line':
+                self.current[frame] = (frame.f_lineno, now)
+        return self.trace_lines
+
+    def location(self, code, lineno):
+        if code in self.templates:
+            index, jinja_template = self.templates[code]
+            lineno = jinja_template.get_corresponding_lineno(lineno)
+            return self.macro.source_location(index, lineno) \
+                or f'{self.macro.name} chunk {index} line {lineno}'
+        if code.co_filename.startswith('<python '):
+            return f'python() in {code.co_filename[8:-1]} line {lineno}'
+        return f'{code.co_filename}:{lineno}'
+
+    def slowest(self, count):
+        # Lines of other templates (nested macro calls) have no location
+        totals = {}
+        for (code, lineno), total in self.times.items():
+            if code.co_filename == '<template>' and code not in self.templates:
+                continue
+            location = self.location(code, lineno)
+            totals[location] = totals.get(location, 0.) + total
+        return sorted(totals.items(), key=lambda item: item[1],
+                      reverse=True)[:count]
+
+class MacroStats:
+    __slots__ = ('count', 'render_time', 'render_max', 'python_time',
+                 'python_max', 'dispatch_time', 'dispatch_max', 'max_time')
+    SORT_KEYS = ('total', 'render', 'python', 'dispatch', 'count', 'max')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.render_time = self.render_max = 0.
+        self.python_time = self.python_max = 0.
+        self.dispatch_time = self.dispatch_max = 0.
+        self.max_time = 0.
+
+    def record(self, render, python, dispatch):
+        self.count += 1
+        self.render_time += render
+        self.python_time += python
+        self.dispatch_time += dispatch
+        self.render_max = max(self.render_max, render)
+        self.python_max = max(self.python_max, python)
+        self.dispatch_max = max(self.dispatch_max, dispatch)
+        self.max_time = max(self.max_time, render + python + dispatch)
+
+    @property
+    def total_time(self):
+        return self.render_time + self.python_time + self.dispatch_time
+
+    def sort_key(self, sort):
+        if sort == 'count':
+            return self.count
+        if sort == 'max':
+            return self.max_time
+        return getattr(self, f'{sort}_time')
+
+    def summary(self):
+        ms = lambda seconds: f'{seconds * 1000:.2f}ms'
+        return (f'{self.count} calls, total {ms(self.total_time)} (render '
+                f'{ms(self.render_time)}, python {ms(self.python_time)}, '
+                f'dispatch {ms(self.dispatch_time)}), max {ms(self.max_time)}')
+
+    def get_status(self):
+        return {'count': self.count, 'total_time': self.total_time,
+                'max_time': self.max_time,
+                'render_time': self.render_time, 'render_max': self.render_max,
+                'python_time': self.python_time, 'python_max': self.python_max,
+                'dispatch_time': self.dispatch_time,
+                'dispatch_max': self.dispatch_max}
+
+class MacroDefinition:
+    # The read-only part of a macro, shared by the main instance and every
+    # cluster loading the same section. The source chunks are dropped once
+    # the templates are compiled.
+    __slots__ = ('printer', 'gcode', 'env', 'gcodes', 'chunk_starts',
+                 'workaround_gcode', 'templates', '__weakref__')
+
+    def __init__(self, raw, printer, delimiter, env):
+        self.printer = printer
+        self.gcode = printer.lookup_object('gcode')
+        self.env = env
+        self.workaround_gcode = sys.intern(
+            MacroConfigParser.get_workaround_gcode(raw))
+        self.gcodes = raw.split(delimiter) if delimiter else [raw]
+        # Line of the raw gcode where each chunk starts
+        chunk_starts = []
+        line = 0
+        for gcode in self.gcodes:
+            chunk_starts.append(line)
+            line += gcode.count('\n')
+        self.chunk_starts = tuple(chunk_starts)
+        self.templates = None
+
+    @classmethod
+    def get_definition(cls, key, raw, printer, delimiter, env):
+        if key is None:
+            return cls(raw, printer, delimiter, env)
+        definitions = macro_definitions.setdefault(
+            printer, weakref.WeakValueDictionary())
+        key = (key, delimiter, env)
+        definition = definitions.get(key)
+        if definition is None:
+            definition = definitions[key] = cls(raw, printer, delimiter, env)
+        return definition
 
 class DynamicMacro:
+    __slots__ = ('name', 'definition', 'desc', 'variables', 'rename_existing',
+                 'duration', 'repeat', 'vars', 'render_cache', 'version',
+                 'stream_batch', 'source_key', 'source_path', 'source_lines',
+                 'stats', 'python_elapsed', 'python_executor', 'python_batch',
+                 'kwparams', 'overrides', '_helpers', 'is_delayed_gcode')
+
     def __init__(self,
                 name,
                 raw,
@@ -424,61 +1775,148 @@ class DynamicMacro:
                 rename_existing=None,
                 initial_duration=None,
                 repeat=False,
-                is_delayed_gcode=False):
-        self.name = name
-        self.raw = raw
-        self.printer = printer
-        self.gcode = self.printer.lookup_object('gcode')
-        self.desc = desc
+                is_delayed_gcode=False,
+                env=None,
+                lazy=False,
+                max_variables=0,
+                python_executor=None,
+                cache=False,
+                render_cache_size=16,
+                stream=False,
+                stream_batch=100,
+                python_batch=0,
+                source_path=None,
+                source_lines=None,
+                source_key=None):
+        self.name = sys.intern(name)
+        self.definition = MacroDefinition.get_definition(
+            source_key, raw, printer,
+            delimiter if delimiter != 'NO_DELIMITER' else None,
+            env if env is not None else get_jinja_env())
+        self.desc = sys.intern(desc)
         self.variables = variables
-        self.delimiter = delimiter if delimiter != 'NO_DELIMITER' else None
         self.rename_existing = rename_existing
         self.duration = initial_duration
         self.repeat = repeat
-        self.vars = {}
+        # Variables set with update(), the least recently set are dropped
+        # once there are more than max_variables (0 for unbounded)
+        self.vars = LRUCache(max_variables) if max_variables else {}
+        # Opt-in (cache: params): rendered chunks keyed by the parameters and
+        # the version, which changes with every variable update
+        self.render_cache = LRUCache(render_cache_size) if cache else None
+        self.version = 0
+        # Opt-in (stream: True): dispatch every stream_batch lines while the
+        # template is still rendering, instead of rendering it all first
+        self.stream_batch = stream_batch if stream else 0
+        if self.stream_batch:
+            self.render_cache = None # Would hold the whole output again
+        self.source_key = source_key
+        self.source_path = source_path
+        # File line of each raw line
+        self.source_lines = array.array('I', source_lines or ())
+        self.stats = MacroStats()
+        self.python_elapsed = 0. # Time spent in python() since creation
+        self.python_executor = python_executor # None to run python() inline
+        self.python_batch = python_batch # Commands per gcode() batch, 0 for none
+        self.kwparams = None
+        self.overrides = {} # Top context layer, used by cluster sandboxing
+        self._helpers = None
 
         self.is_delayed_gcode = is_delayed_gcode
 
-        if self.duration:
-            self.reactor = self.printer.get_reactor()
-            self.timer_handler = None
-            self.inside_timer = self.repeat
-            self.printer.register_event_handler(
-                "klippy:ready", self._handle_ready)
-
         if self.rename_existing:
             self.rename()
 
-        if self.delimiter:
-            self.gcodes = self.raw.split(self.delimiter)
-        else:
-            self.gcodes = [self.raw]
-        self.templates = [self.generate_template(
-            gcode) for gcode in self.gcodes]
+        if not lazy:
+            self.templates
+
+    @property
+    def printer(self):
+        return self.definition.printer
+
+    @property
+    def gcode(self):
+        return self.definition.gcode
+
+    @property
+    def env(self):
+        return self.definition.env
+
+    @property
+    def chunk_starts(self):
+        return self.definition.chunk_starts
+
+    @property
+    def workaround_gcode(self):
+        return self.definition.workaround_gcode
+
+    @property
+    def templates(self):
+        # Compiled on first use when lazy, otherwise during __init__
+        definition = self.definition
+        if definition.templates is None:
+            definition.templates = tuple(self.generate_template(
+                gcode, index) for index, gcode in enumerate(definition.gcodes))
+            definition.gcodes = None
+        return definition.templates
+
+    @property
+    def helpers(self):
+        if self._helpers is None:
+            self._helpers = {'update': self.update,
+                             'get_macro_variables': self.get_macro_variables,
+                             'update_from_dict': self.update_from_dict,
+                             'python': self.python,
+                             'python_file': self.python_file}
+        return self._helpers
+
+    def generate_template(self, gcode, index=0):
+        logging.debug('DynamicMacros [%s]:\n%s', self.name, gcode)
+        try:
+            return TemplateWrapper(self.printer, self.env, self.name, gcode)
+        except Exception as e:
+            raise self._locate_error(e, index)
 
-    def _handle_ready(self):
-        waketime = self.reactor.NEVER
-        if self.duration:
-            waketime = self.reactor.monotonic() + self.duration
-        self.timer_handler = self.reactor.register_timer(
-            self._gcode_timer_event, waketime)
+    def render(self, template, index=0):
+        try:
+            return render_template(template, self.kwparams)
+        except Exception as e:
+            raise self._locate_error(e, index)
 
-    def _gcode_timer_event(self, eventtime):
-        self.inside_timer = True
+    def stream(self, template, index=0):
+        try:
+            yield from stream_template(template, self.kwparams)
+        except Exception as e:
+            raise self._locate_error(e, index)
+
+    def source_location(self, index, lineno):
+        # Map a line of a delimiter chunk back to its config file and line
+        if self.source_path is None:
+            return None
+        line = self.chunk_starts[index] + lineno - 1
+        if 0 <= line < len(self.source_lines):
+            return f'{self.source_path}:{self.source_lines[line]}'
+        return str(self.source_path)
+
+    def _locate_error(self, error, index):
+        # TemplateWrapper re-raises Jinja errors as Klipper errors, so look
+        # for the template line on the original exception
+        cause = error.__context__ or error
+        lineno = getattr(cause, 'lineno', None)
+        tb = cause.__traceback__
+        while lineno is None and tb is not None:
+            if tb.tb_frame.f_code.co_filename == '<template>':
+                lineno = tb.tb_lineno
+            tb = tb.tb_next
+        location = self.source_location(index, lineno or 1)
+        if location is None:
+            return error
         try:
-            self.run({}, '')
+            located = type(error)(f'{str(error).rstrip()} (at {location})')
         except Exception:
-            pass
-        nextwake = self.reactor.NEVER
-        if self.repeat:
-            nextwake = eventtime + self.duration
-        self.inside_timer = False
-        return nextwake
-
-    def generate_template(self, gcode):
-        env = jinja2.Environment('{%', '%}', '{', '}')
-        logging.info(f'DynamicMacros [{self.name}]: \n{clean_gcode(gcode)}')
-        return TemplateWrapper(self.printer, env, self.name, gcode)
+            return error
+        located.__cause__ = cause
+        return located
 
     def rename(self):
         prev_cmd = self.gcode.register_command(self.name, None)
@@ -488,6 +1926,7 @@ class DynamicMacro:
 
     def update(self, name, val):
         self.vars[name] = val
+        self.version += 1
         return val
 
     def get_macro_variables(self, macro_name):
@@ -496,54 +1935,100 @@ class DynamicMacro:
 
     def update_from_dict(self, dictionary):
         self.vars.update(dictionary)
+        self.version += 1
         return dictionary
 
     def python(self, python, *args, **kwargs):
-        key = f'_python{token_hex()}'
+        # Per-call return slot, freed when the call returns
+        result = [None]
 
         def output(value):
-            return self.update(key, value)
-        python_vars = {**self.kwparams, 'output': output,
-                       'gcode': self.gcode.run_script_from_command, 'printer': self.printer}
-        python_vars['print'] = lambda *args: self.gcode.run_script_from_command(
-            'RESPOND MSG="' + ' '.join(map(str, args)) + '"')
+            result[0] = value
+            return value
+        python_vars = {**self.kwparams, 'output': output, 'printer': self.printer}
         python_vars['args'] = args
         python_vars['kwargs'] = kwargs
+        # The template context carries Jinja's globals (range, dict, ...),
+        # which must not shadow the Python builtins
+        for name, value in self.env.globals.items():
+            if python_vars.get(name) is value:
+                del python_vars[name]
+        # Functions that must run on the reactor thread
+        batch = None
+        if self.python_batch:
+            batch = GCodeBatch(
+                self.gcode.run_script_from_command, self.python_batch, python_vars)
+            python_vars['gcode'] = batch.gcode
+            python_vars['print'] = batch.print
+            reactor_calls = {'flush': batch.flush}
+        else:
+            reactor_calls = {'gcode': self.gcode.run_script_from_command}
+            reactor_calls['print'] = lambda *args: self.gcode.run_script_from_command(
+                'RESPOND MSG="' + ' '.join(map(str, args)) + '"')
+            python_vars['flush'] = lambda: None # Nothing is ever queued
+        for name in ('python', 'python_file'):
+            if name in python_vars:
+                reactor_calls[name] = python_vars[name]
+        start = time.perf_counter()
         try:
-            exec(python, python_vars)
+            if not isinstance(python, types.CodeType):
+                python = compile_python(python, f'<python {self.name}>')
+            if self.python_executor is None:
+                python_vars.update(reactor_calls)
+                exec(python, python_vars)
+            else:
+                self.python_executor.execute(python, python_vars, reactor_calls)
+        except PythonTimeoutError:
+            batch = None # The worker may still be queueing
+            self._report_python_error()
         except Exception as e:
-            stderr = StringIO()
-            traceback.print_exc(file=stderr)
-            self.gcode.respond_info(f'Python Error:\n{stderr.getvalue()}')
-        return self.vars.get(key)
+            self._report_python_error()
+        # Commands queued before the block ended (or failed) are sent, as
+        # they would have been without batching
+        if batch is not None:
+            try:
+                batch.flush()
+            except Exception:
+                self._report_python_error()
+        self.python_elapsed += time.perf_counter() - start
+        return result[0]
 
     def python_file(self, fname, *args, **kwargs):
+        path = config_path / fname
         try:
-            with open(config_path / fname, 'r') as file:
-                text = file.read()
-        except Exception as e:
-            self.gcode.respond_info(f'Python file missing: {config_path / fname}')
+            code = load_python_file(path)
+        except OSError:
+            self.gcode.respond_info(f'Python file missing: {path}')
+            return
+        except Exception:
+            self._report_python_error()
             return
-        return self.python(text, *args, **kwargs)
+        return self.python(code, *args, **kwargs)
+
+    def _report_python_error(self):
+        stderr = StringIO()
+        traceback.print_exc(file=stderr)
+        self.gcode.respond_info(f'Python Error:\n{stderr.getvalue()}')
 
     @staticmethod
-    def from_section(config, section, printer, delimiter):
-        raw = config.get(section, 'gcode')
+    def from_section(section, printer, delimiter, **options):
+        raw = section.get('gcode')
         raw = clean_gcode(raw)
 
-        name = section.split()[1]
+        name = section.name.split()[1]
         # logging.info(f'DynamicMacros [{name}] Raw:\n{raw}')
 
-        desc = config.get(section, 'description', fallback='No Description')
-        rename_existing = config.get(section, 'rename_existing', fallback=None)
+        desc = section.get('description', fallback='No Description')
+        rename_existing = section.get('rename_existing', fallback=None)
 
-        initial_duration = config.getfloat(
-            section, 'initial_duration', fallback=None)
-        repeat = config.getboolean(section, 'repeat', fallback=False)
-        is_delayed_gcode = 'delayed_gcode' in section
+        initial_duration = section.getfloat('initial_duration', fallback=None)
+        repeat = section.getboolean('repeat', fallback=False)
+        is_delayed_gcode = 'delayed_gcode' in section.name
+        cache = section.get('cache', fallback='none').strip().lower() == 'params'
+        stream = section.getboolean('stream', fallback=False)
 
-        variables = {key[len('variable_'):]: value for key, value in config.items(
-            section) if key.startswith('variable_')}
+        variables = {sys.intern(key[len('variable_'):]): value for key, value in section.items(
+            ) if key.startswith('variable_')}
         for k, v in variables.items():
             try:
                 variables[k] = ast.literal_eval(v)
@@ -559,41 +2044,107 @@ class DynamicMacro:
                             rename_existing=rename_existing,
                             initial_duration=initial_duration,
                             repeat=repeat,
-                            is_delayed_gcode=is_delayed_gcode)
+                            is_delayed_gcode=is_delayed_gcode,
+                            cache=cache,
+                            stream=stream,
+                            source_path=section.path,
+                            source_lines=section.gcode_lines(),
+                            **options)
 
     def get_status(self, eventtime=None):
         return self.variables
 
-    def _update_kwparams(self, template, params, rawparams):
-        kwparams = {**self.variables, **self.vars,
-                    **template.create_template_context()}
-        kwparams.update({'params': params, 'rawparams': rawparams, 'update': self.update, 'get_macro_variables': self.get_macro_variables,
-                        'update_from_dict': self.update_from_dict, 'python': self.python, 'python_file': self.python_file})
-        self.kwparams = kwparams
-
-    def update_kwparams(self, template, params, rawparams):
-        self._update_kwparams(template, params, rawparams)
+    def create_context(self, params, rawparams):
+        # Top layer of the template context, built once per run
+        return {**self.helpers, 'params': params, 'rawparams': rawparams,
+                **self.overrides}
+
+    def refresh_context(self, run_layer, template):
+        # Layers from lowest to highest priority, flattened once per chunk
+        # into the dict Jinja renders against. The lower layers are read
+        # again so every chunk sees update() results and the printer state
+        # at the time it is rendered.
+        return {**self.env.globals, **self.variables, **self.vars,
+                **template.create_template_context(), **run_layer}
+
+    def cached_scripts(self, params, rawparams):
+        if self.render_cache is None:
+            return None
+        return self.render_cache.lookup(
+            (tuple(sorted(params.items())), rawparams, self.version))
+
+    def cache_scripts(self, params, rawparams, scripts):
+        # Keyed by the version after rendering, which may have changed it
+        if self.render_cache is not None:
+            self.render_cache[
+                (tuple(sorted(params.items())), rawparams, self.version)] = scripts
 
     def run(self, params, rawparams):
-        for template in self.templates:
-            self._run(template, params, rawparams)
-
-    def _run(self, template, params, rawparams):
-        self.update_kwparams(template, params, rawparams)
-        template.run_gcode_from_command(self.kwparams)
-
-    # Handle UPDATE_DELAYED_GCODE command
-    def cmd_UPDATE_DELAYED_GCODE(self, gcmd):
-        if not self.is_delayed_gcode:
-            raise gcmd.error('Not a [delayed_gcode]!')
-        self.duration = gcmd.get_float('DURATION', minval=0)
-        if self.inside_timer:
-            self.repeat = (self.duration != 0.)
+        times = [0., 0., 0.] # render, python, dispatch
+        scripts = self.cached_scripts(params, rawparams)
+        if scripts is not None:
+            start = time.perf_counter()
+            for script in scripts:
+                self.gcode.run_script_from_command(script)
+            times[2] += time.perf_counter() - start
         else:
-            waketime = self.reactor.NEVER
-            if self.duration:
-                waketime = self.reactor.monotonic() + self.duration
-            self.reactor.update_timer(self.timer_handler, waketime)
+            scripts = []
+            context = self.create_context(params, rawparams)
+            run = self._run_streamed if self.stream_batch else self._run
+            for index, template in enumerate(self.templates):
+                scripts.append(run(template, context, times, index))
+            self.cache_scripts(params, rawparams, scripts)
+        self.stats.record(*times)
+
+    def _run(self, template, context, times, index=0):
+        # Recursive calls replace self.kwparams, so set it for every chunk
+        self.kwparams = self.refresh_context(context, template)
+        python_start = self.python_elapsed
+        start = time.perf_counter()
+        script = self.render(template, index)
+        rendered = time.perf_counter()
+        python = self.python_elapsed - python_start
+        times[0] += rendered - start - python
+        times[1] += python
+        self.gcode.run_script_from_command(script)
+        times[2] += time.perf_counter() - rendered
+        return script
+
+    def _run_streamed(self, template, context, times, index=0):
+        kwparams = self.kwparams = self.refresh_context(context, template)
+        python_start = self.python_elapsed
+        start = time.perf_counter()
+        dispatch = 0.
+        output = self.stream(template, index)
+        pieces = []
+        lines = 0
+        while True:
+            # Jinja yields many small pieces, take them a few at a time
+            chunk = list(itertools.islice(output, 64))
+            if chunk:
+                text = ''.join(chunk)
+                pieces.append(text)
+                lines += text.count('\n')
+                if lines < self.stream_batch:
+                    continue
+                # Send the complete lines, keep the start of the last one
+                script, _, partial = ''.join(pieces).rpartition('\n')
+                pieces = [partial]
+                lines = 0
+            else:
+                script = ''.join(pieces)
+            dispatch_start = time.perf_counter()
+            self.gcode.run_script_from_command(script)
+            dispatch += time.perf_counter() - dispatch_start
+            if not chunk:
+                break
+            # Recursive calls replace self.kwparams, put it back for the
+            # python() calls in the rest of the template
+            self.kwparams = kwparams
+        python = self.python_elapsed - python_start
+        times[0] += time.perf_counter() - start - dispatch - python
+        times[1] += python
+        times[2] += dispatch
 
 def load_config(config):
     return DynamicMacros(config)
@@ -0,0 +1,114 @@
+# parse_config must read macro files exactly as RawConfigParser would
+
+import configparser
+
+import pytest
+
+from benchmarks.klippy import load_dynamicmacros
+
+dm = load_dynamicmacros()
+
+CORPUS = {
+    'comments': """\
+# full line comment
+; another one
+[gcode_macro A]
+description: Comments # stripped
+gcode:
+    G1 X1 ; inline
+    M117 a;b ;c #d
+    M117 a#b;c
+    M117 a;b#c ;d
+    ; indented comment line
+    # and another
+    M117 #only
+    M118 ;;x
+""",
+    'continuations': """\
+[gcode_macro B]
+gcode:
+    {% if params.X %}
+      G1 X{params.X}
+    {% endif %}
+    G28
+variable_list: [1,
+    2,
+    3]
+""",
+    'blank lines': """\
+[gcode_macro C]
+gcode:
+    G1 X1
+
+    G1 X2
+
+
+    G1 X3 ; with comment
+
+description: after blank lines
+
+""",
+    'duplicate sections': """\
+[gcode_macro D]
+description: first
+gcode:
+    G1 X1
+[gcode_macro E]
+gcode: M117 e
+[gcode_macro D]
+description: second
+variable_extra: 1
+""",
+    'default section': """\
+[DEFAULT]
+description: From defaults
+variable_speed: 100
+[gcode_macro H]
+gcode: G1 F{speed}
+[gcode_macro I]
+description: Own description
+variable_speed: 200
+gcode: G1 F{speed}
+[DEFAULT]
+rename_existing: I_BASE
+""",
+    'option forms': """\
+[delayed_gcode F]
+initial_duration = 1.5
+Repeat: True
+gcode: M117 f ; inline
+  M117 continued
+empty:
+""",
+}
+
+
+def stdlib_sections(text):
+    config = configparser.RawConfigParser(
+        strict=False, inline_comment_prefixes=(';', '#'))
+    config.read_string(text)
+    return {name: dict(config.items(name, raw=True))
+            for name in config.sections()}
+
+
+def parsed_sections(text):
+    sections = dm.merge_sections(
+        dm.parse_config('test.cfg', text.splitlines()))
+    return {name: section.options for name, section in sections.items()}
+
+
+@pytest.mark.parametrize('name', CORPUS)
+def test_matches_rawconfigparser(name):
+    assert parsed_sections(CORPUS[name]) == stdlib_sections(CORPUS[name])
+
+
+def test_value_line_numbers():
+    section, = dm.parse_config('test.cfg', CORPUS['blank lines'].splitlines())
+    assert section.gcode_lines() == [3, 5, 8]
+
+
+def test_errors_match_rawconfigparser():
+    with pytest.raises(configparser.MissingSectionHeaderError):
+        dm.parse_config('test.cfg', ['gcode: G28'])
+    with pytest.raises(configparser.ParsingError):
+        dm.parse_config('test.cfg', ['[gcode_macro G]', 'not an option'])
@@ -0,0 +1,44 @@
+# Commands claimed by the generated [gcode_macro] sections are taken back
+# by the dynamic macros once Klipper is ready
+
+from benchmarks.klippy import Printer, load_dynamicmacros
+
+MACROS = """\
+[gcode_macro FOO]
+variable_x: 1
+gcode:
+    M117 foo {x}
+
+[gcode_macro bar]
+gcode:
+    M117 bar
+"""
+
+
+def placeholder(gcmd):
+    gcmd.respond_info('placeholder')
+
+
+def test_ready_takes_back_placeholder_commands(tmp_path):
+    (tmp_path / 'printer.cfg').write_text('[printer]\nkinematics: none\n')
+    (tmp_path / 'macros.cfg').write_text(MACROS)
+    dm = load_dynamicmacros()
+    printer = Printer(tmp_path)
+    gcode = printer.lookup_object('gcode')
+    # What Klipper's gcode_macro registers for .dynamicmacros.cfg
+    gcode.register_command('FOO', placeholder)
+    gcode.register_command('BAR', placeholder)
+    main = printer.load(dm, 'dynamicmacros', {'configs': 'macros.cfg'})
+    printer.ready()
+    printer.reactor.run_due()
+
+    for name in ('FOO', 'BAR'):
+        assert gcode.ready_gcode_handlers[name] is not placeholder
+        assert printer.objects[f'gcode_macro {main.macros[name].name}'] \
+            is main.macros[name]
+    gcode.run_script_from_command('SET_DYNAMIC_VARIABLE MACRO=FOO '
+                                  'VARIABLE=x VALUE=2')
+    gcode.run_script_from_command('FOO')
+    gcode.run_script_from_command('BAR')
+    assert gcode.executed[-2:] == ['M117 foo 2', 'M117 bar']
+    assert printer.objects['gcode_macro FOO'].get_status() == {'x': 2}
@@ -0,0 +1,41 @@
+# .dynamicmacros.cfg is regenerated while loading, so a stale file that
+# Klipper rejects before klippy:connect is fixed for the next restart
+
+from benchmarks.klippy import Printer, load_dynamicmacros
+
+
+def boot(config_dir, clusters=True, connect=True):
+    dm = load_dynamicmacros()
+    printer = Printer(config_dir)
+    printer.load(dm, 'dynamicmacros', {'configs': 'a.cfg'})
+    if clusters:
+        printer.load(dm, 'dynamicmacros sb', {'configs': 'b.cfg'})
+    if connect:
+        printer.ready()
+
+
+def test_workaround_rewritten_during_load(tmp_path):
+    (tmp_path / 'printer.cfg').write_text('[printer]\nkinematics: none\n')
+    (tmp_path / 'a.cfg').write_text('[gcode_macro A]\ngcode:\n    M117 a\n')
+    (tmp_path / 'b.cfg').write_text('[gcode_macro B]\ngcode:\n    M117 b\n')
+    workaround = tmp_path / '.dynamicmacros.cfg'
+    boot(tmp_path)
+    assert 'CLUSTER=sb' in workaround.read_text()
+    assert '[include .dynamicmacros.cfg]' in (tmp_path / 'printer.cfg').read_text()
+
+    # Unchanged content is not rewritten
+    mtime = workaround.stat().st_mtime_ns
+    boot(tmp_path)
+    assert workaround.stat().st_mtime_ns == mtime
+
+    # A stale option is dropped before connect, and the sections of the
+    # cluster that has not loaded yet are kept
+    workaround.write_text(workaround.read_text().replace(
+        '[gcode_macro A]', '[gcode_macro A]\ntypo: 1'))
+    boot(tmp_path, clusters=False, connect=False)
+    assert 'typo' not in workaround.read_text()
+    assert 'CLUSTER=sb' in workaround.read_text()
+
+    # Once connected, only the loaded instances remain
+    boot(tmp_path, clusters=False)
+    assert 'CLUSTER=sb' not in workaround.read_text()